@@ -1,9 +1,18 @@
-from collections import defaultdict
-from typing import Optional
+import os
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Optional, Union
 
 import gradio as gr
 
-from achievements.definitions import achievements_map, achievements_rolls, achievements_sequence, achievements_text
+from achievements.definitions import (
+    SequenceAchievement,
+    achievements_map,
+    achievements_rolls,
+    achievements_sequence,
+    achievements_text,
+)
+from achievements.matcher import Matcher
 
 
 def display_raw(title: str, text: str):
@@ -21,8 +30,8 @@ def display(key: str):
         gr.Error(f'Failed to find data for achievement "{key}"...')
 
 
-def update_achievements(chat_history: list[list[Optional[str]]], state: dict) -> str:
-    """Computes the state of achievements given a game state."""
+def update_achievements(chat_history: list[list[Optional[str]]], state: dict) -> Union[str, dict]:
+    """Computes the state of achievements given a game state, skipping the panel update if none was unlocked."""
     if "hello" not in state["achievements"]:
         display("hello")
         state["achievements"]["hello"] = True
@@ -32,36 +41,45 @@ def update_achievements(chat_history: list[list[Optional[str]]], state: dict) ->
     if chat_history is not None and len(chat_history) > 0:
         check_history(chat_history, state)
 
-    current_achievements = state.get("achievements", [])
-    current = len(current_achievements)
+    unlocked = frozenset(state.get("achievements", []))
+    if unlocked == state.get("shown"):
+        return gr.skip()
+    state["shown"] = unlocked
+    return render_achievements(unlocked)
+
+
+@lru_cache(maxsize=256)
+def render_achievements(unlocked: frozenset[str]) -> str:
+    """The Markdown of the achievements panel, the same for any player with the same unlocked achievements."""
+    current = len(unlocked)
     total = len(achievements_map)
     achievement_text = f"# {current}/{total} Achievements unlocked! \n"
     done = []
 
-    if not current_achievements:
+    if not unlocked:
         return achievement_text
 
     # VISIBLE ACHIEVEMENTS
     # Rolls
     achievement_text += "## Rolls  \n"
     for roll in achievements_rolls:
-        if roll.key in current_achievements:
+        if roll.key in unlocked:
             achievement_text += f"### 🔓 {roll.title}  \n> {roll.text}  \n"
             done.append(roll.key)
     # Sequences
     achievement_text += "## Sequences  \n"
     for sequence in achievements_sequence:
-        if sequence.key in current_achievements:
+        if sequence.key in unlocked:
             achievement_text += f"### 🔓 {sequence.title}  \n> {sequence.text}  \n"
             done.append(sequence.key)
     # Texts
     achievement_text += "## Sacred Texts  \n"
     for text in achievements_text:
-        if text.key in current_achievements:
+        if text.key in unlocked:
             achievement_text += f"### 🔓 {text.title}  \n> {text.text}  \n"
             done.append(text.key)
 
-    remains = [r for r in current_achievements if r not in done]
+    remains = [r for r in achievements_map if r in unlocked and r not in done]  # In order of definition
     if remains:
         achievement_text += f"## Others\n"
         for r_key in remains:
@@ -82,36 +100,70 @@ def check_rolls(state: dict) -> None:
                 state["achievements"][achievement.key] = True
 
 
+roll_matcher = Matcher(achievement.sequence for achievement in achievements_sequence)
+sequences: dict[str, list[SequenceAchievement]] = defaultdict(list)
+for _achievement in achievements_sequence:
+    sequences[_achievement.sequence].append(_achievement)
+
+
+def encode_roll(roll: int) -> str:
+    """One character per roll, 10s as 0s: see SequenceAchievement."""
+    return str(roll % 10)
+
+
 def check_sequence_achievements(state: dict) -> None:
-    sequence = "".join(str(i if i != 10 else "@") for i in state["rolls"])
+    """Feeds the rolls made since last time to the sequence matcher, resuming where it stopped."""
+    consumed, matched = state.get("roll_scan", (0, 0))
+    rolls = state["rolls"]
+    if consumed > len(rolls):  # A new game
+        consumed, matched = 0, 0
+    for roll in rolls[consumed:]:
+        matched = roll_matcher.step(matched, encode_roll(roll))
+        for sequence in roll_matcher.matches(matched):
+            for achievement in sequences[sequence]:
+                if achievement.key not in state["achievements"]:
+                    display(achievement.key)
+                    state["achievements"][achievement.key] = True
+    state["roll_scan"] = (len(rolls), matched)
+
+
+def load_words(path: str) -> list[str]:
+    with open(path, "r") as f:
+        return [w.strip() for w in f.readlines() if not w.startswith("#") and w.strip()]
+
 
-    for achievement in achievements_sequence:
-        if achievement.key not in state["achievements"] and achievement.sequence in sequence:
-            display(achievement.key)
-            state["achievements"][achievement.key] = True
+DATA = os.path.join(os.path.dirname(__file__), "data")
+AI_WORDS = load_words(os.path.join(DATA, "100_ai_words.txt"))
+AI_AVOID = load_words(os.path.join(DATA, "100_to_avoid.txt"))
+text_matcher = Matcher([text.keyword for text in achievements_text] + AI_WORDS + AI_AVOID)
 
 
 def check_history(chat_history: list[list[Optional[str]]], state: dict) -> None:
-    score_ai_words, score_ai_avoid = 0, 0
-    fulltext = ",".join([t for h in chat_history for t in h if t is not None])
+    """
+    Scans new messages for keywords, as if in the history joined by commas.
+    Messages are scanned once for good, except for the last one which may still be streaming:
+    it is rescanned from where the others stopped at each change, and its counts are never kept.
+    """
+    messages = [t for h in chat_history for t in h if t is not None]
+    scanned, matched, counts = state.get("text_scan", (0, 0, Counter()))
+    if scanned > len(messages):  # A new game
+        scanned, matched, counts = 0, 0, Counter()
+    for message in messages[scanned:-1]:
+        matched, counts = text_matcher.scan(f",{message}" if scanned else message, matched, counts)
+        scanned += 1
+    state["text_scan"] = (scanned, matched, counts)
+
+    if scanned < len(messages):
+        last = messages[-1]
+        _, counts = text_matcher.scan(f",{last}" if scanned else last, matched, counts.copy())
 
     for text in achievements_text:
-        if text.key not in state["achievements"] and text.match(fulltext):
+        if text.key not in state["achievements"] and counts[text.keyword] >= text.times:
             display(text.key)
             state["achievements"][text.key] = True
 
-    with open("./achievements/data/100_ai_words.txt", "r") as f:
-        words = [w.strip() for w in f.readlines() if not w.startswith("#")]
-        for word in words:
-            if word in fulltext:
-                print(f"Found {word} in history!")
-                score_ai_words += 1
-    with open("./achievements/data/100_to_avoid.txt", "r") as f:
-        words = [w.strip() for w in f.readlines() if not w.startswith("#")]
-        for word in words:
-            if word in fulltext:
-                print(f"Found {word} in history!")
-                score_ai_avoid += 1
+    score_ai_words = sum(1 for word in AI_WORDS if counts[word])
+    score_ai_avoid = sum(1 for word in AI_AVOID if counts[word])
     # TODO Create achievements based on scores
     if score_ai_words > 0 or score_ai_avoid > 0:
         print(f"Found AI words! Total AI word scores: {score_ai_words}, {score_ai_avoid}")
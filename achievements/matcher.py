@@ -0,0 +1,70 @@
+"""Multi-pattern matching over streamed text: an Aho-Corasick automaton, fed one message (or one roll) at a time."""
+
+from collections import Counter, deque
+from typing import Iterable, Optional
+
+
+class Matcher:
+    """Finds all occurrences of many patterns in a single pass, whatever their number.
+
+    States are plain ints, so a caller can keep where it stopped (e.g. in a session's state) and feed more text later:
+    matches spanning both feeds are found as if the text had been scanned at once.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: list[str] = list(dict.fromkeys(p for p in patterns if p))
+        self._goto: list[dict[str, int]] = [{}]  # The trie of patterns
+        self._fail: list[int] = [0]  # Longest proper suffix of a state which is also a state
+        self._outputs: list[list[int]] = [[]]  # Patterns ending at a state, including through its suffixes
+        self._delta: list[dict[str, int]] = [{}]  # Transitions resolved so far, making each step O(1) once seen
+
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                    self._delta.append({})
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._outputs[state].append(index)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                self._fail[child] = self.step(self._fail[state], char) if state else 0
+                self._outputs[child] += self._outputs[self._fail[child]]
+
+    def step(self, state: int, char: str) -> int:
+        """The state after reading one more character."""
+        delta = self._delta[state]
+        if char not in delta:
+            if char in self._goto[state]:
+                delta[char] = self._goto[state][char]
+            else:
+                delta[char] = self.step(self._fail[state], char) if state else 0
+        return delta[char]
+
+    def matches(self, state: int) -> list[str]:
+        """The patterns ending right at this state."""
+        return [self.patterns[index] for index in self._outputs[state]]
+
+    def scan(self, text: str, state: int = 0, counts: Optional[Counter] = None) -> tuple[int, Counter]:
+        """
+        Counts occurrences of each pattern in the text, overlapping ones included.
+        :param state: where a former scan stopped, to resume it
+        :param counts: former counts to add to, if any
+        :return: a tuple: the state to resume from, counts of each pattern found
+        """
+        counts = Counter() if counts is None else counts
+        for char in text:
+            state = self.step(state, char)
+            for index in self._outputs[state]:
+                counts[self.patterns[index]] += 1
+        return state, counts
+
+    def __len__(self) -> int:
+        return len(self.patterns)
@@ -1,7 +1,9 @@
-import datetime
+import asyncio
+import functools
 import json
-from dataclasses import dataclass
-from typing import Any, Optional
+import threading
+from dataclasses import dataclass, replace
+from typing import Any, Awaitable, Callable, Optional
 
 import gradio as gr
 from PIL.Image import Image
@@ -9,13 +11,43 @@ from PIL.Image import Image
 from achievements.logic import init_achievements
 from achievements.logic import update_achievements
 from narrator import GameNarrator
+import oracle
 from oracle import choose_model
 from prompts import IMAGE_STYLE_NAMES, IMAGE_STYLES, IMAGE_STYLE_DEFAULT
-from state import GameState
-from stories.story import story_cat_moon, story_rforest, Story
-from visuals.diffuse import text2image
+from speculation import Speculator
+from state import GameState, SessionStore
+from stories.story import TINY_EXTRACTION, story_cat_moon, story_rforest, Story
+from utils.metrics import metrics
+from utils.save import generation_log
+from visuals.batching import Batcher
+from visuals.diffuse import cached, image_params, text2image_batch, warmup
+from visuals.jobs import LatestWins
+from visuals.worker import ImageWorkers
 
 DEBUG_LOCAL_INIT = False
+RESPONSE_CACHE = False  # Serve repeated prompts (e.g. game openings) from disk
+SINGLE_CALL_TURNS = False  # Ask for each turn in one reply, falling back to step by step calls
+SPECULATIVE = False  # Pre-generate the result of every offered option while the player reads
+TINY_EXTRACTION_MODELS = False  # Extract locations and objectives with a tiny model, if installed, see TINY_EXTRACTION
+IMAGE_WORKERS = 1  # Processes rendering illustrations, or 0 to render them in the web server
+IMAGE_PREVIEWS = False  # Show rough previews of illustrations while they render, at the cost of batching them
+ILLUSTRATION_CONCURRENCY = None  # Sessions illustrating at once: Gradio's default of 1 would leave nothing to batch
+
+background_tasks: set[asyncio.Task] = set()  # Strong references, so pending tasks aren't garbage-collected
+
+
+def in_background(coroutine) -> asyncio.Task:
+    """Runs a coroutine between turns without making the player wait for it, after their own calls."""
+    task = asyncio.create_task(oracle.as_background(coroutine))
+    background_tasks.add(task)
+    task.add_done_callback(background_done)
+    return task
+
+
+def background_done(task: asyncio.Task) -> None:
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task failed: {task.exception()}")
 
 
 def vote(data: gr.LikeData):
@@ -37,45 +69,87 @@ class Generation:
 def save_generation(prompt: str, response: str, model: Optional[str] = None, extra: Optional[dict] = None) -> None:
     if model is None:
         model = choose_model()
-    data = Generation(prompt, response, model, extra)
-    timestamp = int(datetime.datetime.now().timestamp())
-    with open(f"generated/{timestamp}.json", "w") as file:
-        json.dump(data.__dict__, file)
+    generation_log.append(Generation(prompt, response, model, extra).__dict__)
+
 
+def overload_as_error(respond_fn):
+    """Shows players a message when the oracle sheds their calls, rather than a bare error."""
+
+    @functools.wraps(respond_fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            async for outputs in respond_fn(*args, **kwargs):
+                yield outputs
+        except oracle.Overloaded as e:
+            raise gr.Error(f"The oracle is overwhelmed by players, please retry in a moment! ({e})")
 
-def respond(button: str, chat_history, json_src: str, achievements: dict):
+    return wrapper
+
+
+@overload_as_error
+async def respond(button: str, chat_history, json_src: str, achievements: dict, request: gr.Request):
     """
     Respond to the user's choice, advancing the story.
+    Oracle calls are awaited, so a pending generation doesn't hold a Gradio worker thread.
 
-    The response flows along these steps:
+    The response flows along these steps, unless the narrator plays `single_call` turns
+    where one reply holds the action result, location, objective and new options:
     - User Choice
-    - Action result/D10 = describe(choice)
+    - Action result/D10 = describe(choice), streamed as it is written unless it was speculated
     - Update state with long description
-    - Location = curLocation(state)
-    - Objective = curLocation(state)
+    - Location = curLocation(state) | Objective = curObjective(state), concurrently
     - Update state with location+objective
     - New situation = display(location+objective)
     - New options = generate3(new situation)
+    - In the background, summarize older history and speculate on the new options
 
     :param button: user choice
     :param chat_history: stateful history so far
     :param achievements: state of achievements and related data
     :param json_src: maintain displayed JSON until generation updates it
+    :param request: the player's request, whose session holds their game state
     :return:
     """
     print(f"Choice: {button}")
+    game_state = sessions.get(request.session_hash)
+    oracle.current_session.set(request.session_hash)  # Queue our calls fairly with other players'
     chat_history.append((button, None))  # Add immediately the player's chosen action
     yield "", "", "", chat_history, "", json_src
 
-    action_results, json_output, d10 = narrator.describe_action_result(game_state, button)
+    speculated = speculator.claim(game_state, button) if speculator is not None else None
+    d10 = narrator.roll() if speculated is None else speculated[0]
+    header = f"## Action Result: rolled a {d10}/10 🔷\n"
+    chat_history.append((None, header))
+    result, turn = None, None
+    if speculated is not None:  # Its result was generated while the player was reading
+        try:
+            result = await speculated[1]
+        except RuntimeError as e:  # Including Overloaded: speculations are shed first, the player's call may not be
+            print(f"Speculation failed, generating again: {e}")
+    if result is None and narrator.single_call:  # Try getting the whole turn in one reply
+        try:
+            async for long_version, turn in narrator.astream_turn(game_state, button, d10):
+                if turn is None:  # Stream the action result as it is written
+                    chat_history[-1] = (None, f"{header}{long_version}")
+                    yield "", "", "", chat_history, "", json_src
+        except oracle.Overloaded:
+            raise
+        except RuntimeError as e:
+            print(f"Turn engine failed, playing step by step: {e}")
+    if result is None and turn is None:
+        async for long_version, result in narrator.astream_action_result(game_state, button, d10):
+            if result is None:  # Stream the action result as it is written
+                chat_history[-1] = (None, f"{header}{long_version}")
+                yield "", "", "", chat_history, "", json_src
+    if turn is None:
+        action_results, json_output, _ = result
+    else:
+        action_results, json_output = turn
     game_state.update([action_results["short_version"], action_results["long_version"]])
     achievements["rolls"].append(d10)
-    chat_history.append(
-        (
-            None,
-            f"## Action Result: rolled a {d10}/10 🔷\n###  {action_results['short_version']}  \n"
-            f"{action_results['long_version']}",
-        )
+    chat_history[-1] = (
+        None,
+        f"{header}###  {action_results['short_version']}  \n{action_results['long_version']}",
     )  # Display action result
     yield "", "", "", chat_history, "", json_output
 
@@ -87,18 +161,33 @@ def respond(button: str, chat_history, json_src: str, achievements: dict):
     # chat_history.append((None, f"## {descriptions['short_version']}\n{descriptions['long_version']}"))
     # yield "", "", "", chat_history, "", json_output
 
-    location, _ = narrator.current_location(game_state)
-    objective, _ = narrator.current_objective(game_state)
-    game_state.update(None, location["short_version"], objective)
+    if turn is not None:
+        game_state.update(None, action_results["location"], action_results["objective"])
+        new_situation = narrator.display_information(game_state)
+        new_options, response = action_results["options"], json_output
+    else:
+        (location, _), (objective, _) = await asyncio.gather(
+            narrator.acurrent_location(game_state),
+            narrator.acurrent_objective(game_state),
+        )
+        game_state.update(None, location["short_version"], objective)
 
-    new_situation = narrator.display_information(game_state)
+        new_situation = narrator.display_information(game_state)
+        new_options, response = await narrator.agenerate_options(
+            game_state, new_situation, action_results["long_version"]
+        )
     print(f"FINAL SITUATION: {new_situation}")
-    new_options, response = narrator.generate_options(new_situation, action_results["long_version"])
     print(f"FINAL OPTIONS: {new_options}")
+    if oracle.response_cache is not None:
+        print(oracle.response_cache)
+    print(metrics)
+    in_background(narrator.asummarize(game_state))  # Fold older history while the player reads
+    if speculator is not None:
+        speculator.start(game_state, new_options)  # Prepare each option's result while the player reads
     yield new_options[0], new_options[1], new_options[2], chat_history, new_situation, response
 
 
-def update_image(chat_history, style):
+async def update_image(chat_history, style, request: gr.Request):
     history_texts = [c for x in chat_history for c in x if c is not None]
     selected = [t for t in history_texts if len(t) < 140]  # CLIP: 77 tokens
     selected_history = selected if selected else history_texts
@@ -110,8 +199,63 @@ def update_image(chat_history, style):
             pass
 
     # gr.Info(f"Generating action image in style {style}: {last_action_text[:20]}...")
-    image: Image = text2image(f"{last_action_text}", IMAGE_STYLES[style])
-    return image
+    if not IMAGE_PREVIEWS:
+        image: Optional[Image] = await image_jobs.run(
+            request.session_hash, lambda stale: illustrate(f"{last_action_text}", IMAGE_STYLES[style], stop=stale)
+        )
+        yield gr.update() if image is None else image  # Keep the former illustration rather than a blank one
+        return
+
+    loop, previews = asyncio.get_running_loop(), asyncio.Queue()
+
+    def show(stale: Callable[[], bool]) -> Callable[[list[Image]], None]:
+        def preview(images: list[Image]) -> None:  # Called from the rendering thread, or as a worker sends them
+            if not stale():
+                loop.call_soon_threadsafe(previews.put_nowait, images[0])
+
+        return preview
+
+    job = asyncio.create_task(
+        image_jobs.run(
+            request.session_hash,
+            lambda stale: illustrate(f"{last_action_text}", IMAGE_STYLES[style], stop=stale, preview=show(stale)),
+        )
+    )
+    while not job.done():
+        shown = asyncio.create_task(previews.get())
+        await asyncio.wait([job, shown], return_when=asyncio.FIRST_COMPLETED)
+        if shown.done():
+            yield shown.result()
+        else:
+            shown.cancel()
+    image = job.result()
+    yield gr.update() if image is None else image
+
+
+async def illustrate(
+    caption: str,
+    style: str = "",
+    fast=False,
+    stop: Optional[Callable[[], bool]] = None,
+    preview: Optional[Callable[[list[Image]], None]] = None,
+) -> Optional[Image]:
+    """
+    Renders along with other illustrations requested meanwhile, in a worker process if we have some.
+    :param preview: called every few steps with approximate images. Previews are per request, so they bypass batching.
+    """
+    params = image_params(caption, style, fast, seed=None, preset=None)
+    image = cached(params)
+    if image is not None:  # No need to wait for a batch
+        return image
+    if preview is not None:
+        return (await render_batch([params], stop, preview))[0]
+    return await image_batcher.render(params, stop)
+
+
+def render_in_thread(
+    batch: list[dict[str, Any]], stop: Callable[[], bool], preview: Optional[Callable[[list[Image]], None]] = None
+) -> Awaitable[list[Optional[Image]]]:
+    return asyncio.to_thread(text2image_batch, batch, stop, preview)
 
 
 def generate_caption(story: Story, situation: str) -> str:
@@ -120,9 +264,28 @@ def generate_caption(story: Story, situation: str) -> str:
 
 if __name__ == "__main__":
     print("Running game!")
-    narrator = GameNarrator(story=story_rforest)  # Or e.g. (story=story_cat_moon)
+    image_workers = ImageWorkers(IMAGE_WORKERS) if IMAGE_WORKERS else None
+    if image_workers is not None:
+        image_workers.start()  # Load their illustration pipeline meanwhile
+        render_batch = image_workers.render_batch
+    else:
+        threading.Thread(target=warmup, daemon=True).start()
+        render_batch = render_in_thread
+    image_batcher = Batcher(render_batch)
+    if RESPONSE_CACHE:
+        oracle.enable_cache()
+    story = story_rforest  # Or e.g. story_cat_moon
+    if TINY_EXTRACTION_MODELS:
+        story = replace(story, models=dict(TINY_EXTRACTION))
+    narrator = GameNarrator(story=story, single_call=SINGLE_CALL_TURNS)
     intro = narrator.intro()
     game_state = GameState(intro, narrator.story.situation, narrator.story.goal)
+    speculator = Speculator(narrator) if SPECULATIVE else None
+    sessions = SessionStore(
+        lambda: GameState(intro, narrator.story.situation, narrator.story.goal),
+        on_evict=speculator.cancel if speculator is not None else None,  # Its speculations would run for nobody
+    )
+    image_jobs = LatestWins()
 
     if DEBUG_LOCAL_INIT:
         current_situation = {"long_version": intro}
@@ -132,9 +295,11 @@ if __name__ == "__main__":
         initial_image = None
     else:
         current_situation, _ = narrator.describe_current_situation(game_state)
-        options, json_str = narrator.generate_options(current_situation["long_version"])
+        options, json_str = narrator.generate_options(game_state, current_situation["long_version"])
         current_info = "INFO"
-        initial_image = text2image(generate_caption(story=narrator.story, situation=current_situation["short_version"]), fast=True)
+        initial_image = asyncio.run(
+            illustrate(generate_caption(story=narrator.story, situation=current_situation["short_version"]), fast=True)
+        )
 
     # Theme quickly generated using https://www.gradio.app/guides/theming-guide - try it and change some more!
     theme = gr.themes.Soft(
@@ -189,13 +354,15 @@ if __name__ == "__main__":
         outputs = [action1, action2, action3, chatbot, situation, json_view]
         inputs = [chatbot, json_view, achievements_store]
 
-        action1.click(respond, [action1, *inputs], outputs)
-        action2.click(respond, [action2, *inputs], outputs)
-        action3.click(respond, [action3, *inputs], outputs)
+        # Illustrate each turn once its final state arrived, rather than at every change while streaming it
+        for action in [action1, action2, action3]:
+            action.click(respond, [action, *inputs], outputs).then(
+                update_image, [chatbot, image_style], illustration, concurrency_limit=ILLUSTRATION_CONCURRENCY
+            )
 
-        chatbot.change(update_image, [chatbot, image_style], illustration)
+        # Streaming changes the chat at every token: only the latest pending change needs handling
         chatbot.change(update_achievements, [chatbot, achievements_store], [achievements_display],
-                       show_progress="minimal")
+                       show_progress="minimal", trigger_mode="always_last")
 
     demo.queue()
     demo.launch(allowed_paths=["static/"], favicon_path="static/princess.ico")
@@ -0,0 +1,67 @@
+"""Measures how fast local models generate on this host, caching results on disk."""
+
+import json
+import os
+import socket
+import time
+from dataclasses import asdict, dataclass
+
+import ollama
+
+BENCHMARK_PROMPT = "Tell the beginning of a fairy tale about a brave princess, in three sentences."
+
+
+@dataclass
+class ModelSpeed:
+    model: str
+    digest: str
+    time_to_first_token: float  # Seconds, once the model is loaded
+    tokens_per_second: float
+
+    def latency(self, tokens: int) -> float:
+        """Expected seconds to generate a reply of this many tokens."""
+        return self.time_to_first_token + tokens / self.tokens_per_second
+
+
+def benchmark(model: str, digest: str = "", max_tokens: int = 64) -> ModelSpeed:
+    """Times a short streamed generation with this model."""
+    print(f"Benchmarking {model}... ", end="")
+    start, first_token = time.perf_counter(), None
+    load, tokens_per_second = 0.0, 0.0
+    for part in ollama.generate(
+        model=model, prompt=BENCHMARK_PROMPT, stream=True, options={"num_predict": max_tokens, "temperature": 0}
+    ):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        if part.get("done"):
+            load = part.get("load_duration", 0) / 1e9
+            tokens_per_second = part.get("eval_count", 0) / max(part.get("eval_duration", 0) / 1e9, 1e-9)
+    speed = ModelSpeed(model, digest, max((first_token or 0) - load, 0), max(tokens_per_second, 1e-9))
+    print(f"{speed.time_to_first_token:.2f}s to first token, {speed.tokens_per_second:.1f} tokens/s")
+    return speed
+
+
+def measure(models: dict[str, str], path: str = "") -> dict[str, ModelSpeed]:
+    """
+    Speeds of the given models on this host, only benchmarking those not measured yet.
+    :param models: model names and their digests, so a re-pulled model is measured again
+    :param path: where to cache results, by default one file per host under generated/benchmarks/
+    """
+    if not path:
+        path = f"generated/benchmarks/{socket.gethostname()}.json"
+    cached: dict[str, ModelSpeed] = {}
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            cached = {name: ModelSpeed(**speed) for name, speed in json.load(file).items()}
+
+    speeds = {}
+    for model, digest in models.items():
+        if model in cached and cached[model].digest == digest:
+            speeds[model] = cached[model]
+        else:
+            speeds[model] = cached[model] = benchmark(model, digest)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({name: asdict(speed) for name, speed in cached.items()}, file, indent=2)
+    return speeds
@@ -1,20 +1,44 @@
-import json
 import random
 from json import JSONDecodeError
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Callable, Optional
 
 import gradio as gr
 
-from oracle import Oracle
+import schemas
+from oracle import Oracle, installed
 from state import GameState
 from stories.story import Story
+from utils.metrics import metrics
+from utils.partial_json import StreamedString, repair_json
+
+# What a reply may fail with before we ask the oracle again
+VALIDATION_ERRORS = (JSONDecodeError, AssertionError, IndexError, KeyError, TypeError)
+
+# The JSON replies expected by each task
+REPLY_SCHEMAS: dict[str, dict[str, Any]] = {
+    "situation": schemas.DESCRIPTIONS,
+    "action": schemas.DESCRIPTIONS,
+    "location": schemas.DESCRIPTIONS,
+    "options": schemas.OPTIONS,
+    "turn": schemas.TURN,
+}
 
 
 class GameNarrator:
-    def __init__(self, story: Story = None):
+    """Tells the story through the Oracle.
+
+    Calls are awaitable (e.g. `acurrent_location`), except for the opening which is told before the game is served.
+    Both go through `ask` or `aask`, which share validation and only differ in how they reach the Oracle.
+    In `single_call` mode, a turn is first asked for as a whole with `astream_turn`.
+    Each task is answered by the model its story routes it to, if any, see `model`.
+    """
+
+    def __init__(self, story: Story = None, single_call: bool = False):
         if story is None:
             story = Story()
         self.story = story
+        self.single_call = single_call
+        self.models = self.route_models()
 
     @property
     def pre_prompt(self) -> str:
@@ -25,7 +49,7 @@ class GameNarrator:
             f"and always describe the scene and actions in their {self.story.voice} subjective voice.\n"
             "When possible you use simple words from the basic english vocabulary "
             "to keep the story readable for kids.\n"
-            "You will generate a small part of the story, answering directly this request:\n"
+            "You will generate a small part of the story, answering directly the request after the story so far.\n"
         )
 
     def intro(self) -> str:
@@ -34,66 +58,198 @@ class GameNarrator:
             f"{self.story.situation} {self.story.goal}\n"
         )
 
-    def describe_current_situation(self, game_state: GameState, retries: int = 5) -> tuple[dict[str, str], str]:
-        print("DESCRIBING SITUATION... ", end="")
-        prompt = (
-            f"{self.pre_prompt} determine the current situation of the {self.story.character}. "
-            f"The story so far is the following: \n"
-            f"{game_state.history_so_far()}\n"
+    def prompt(self, game_state: GameState, request: str) -> str:
+        """
+        Lays out a prompt with its request last: every call of a turn then starts with the same pre-prompt
+        and story so far, which the server evaluates once and reuses as long as the model stays loaded.
+        """
+        return f"{self.pre_prompt}The story so far:\n{game_state.history_so_far()}\nThe request: {request}"
+
+    def route_models(self) -> dict[str, str]:
+        """The story's routes to installed models, checked once: tasks routed to a missing model use the default."""
+        routes = {}
+        for task, model in self.story.models.items():
+            if installed(model):
+                routes[task] = model
+            else:
+                print(f"Model {model} for {task} is not installed, using default model.")
+        return routes
+
+    def model(self, task: str) -> Optional[str]:
+        """The model routed to this task by the story, or None for the default model."""
+        return self.models.get(task)
+
+    def ask(self, task: str, prompt: str, parse: Callable[[str], Any], retries: int) -> Optional[tuple[Any, str]]:
+        """
+        Asks the oracle for the task's JSON reply until `parse` accepts it, giving up with None after `retries` tries.
+        Counts calls, retries and failures per task in `metrics`.
+        """
+        metrics.increment(f"{task}.calls")
+        request = dict(is_json=True, schema=REPLY_SCHEMAS[task], model=self.model(task))
+        for attempt in range(retries):
+            if attempt:
+                metrics.increment(f"{task}.retries")
+            prediction, source = Oracle.predict(prompt, **request, fresh=attempt > 0)
+            try:
+                answer = parse(prediction), source
+                Oracle.remember(prompt, prediction, source, **request)
+                return answer
+            except VALIDATION_ERRORS as exc:
+                print(f"Validation failed: {exc}")
+        metrics.increment(f"{task}.failures")
+        return None
+
+    async def aask(
+        self, task: str, prompt: str, parse: Callable[[str], Any], retries: int, tried: int = 0
+    ) -> Optional[tuple[Any, str]]:
+        """Awaitable `ask`, which may continue a call that already `tried` a few times."""
+        if not tried:
+            metrics.increment(f"{task}.calls")
+        request = dict(is_json=True, schema=REPLY_SCHEMAS[task], model=self.model(task))
+        for attempt in range(tried, tried + retries):
+            if attempt:
+                metrics.increment(f"{task}.retries")
+            prediction, source = await Oracle.apredict(prompt, **request, fresh=attempt > 0)
+            try:
+                answer = parse(prediction), source
+                await Oracle.aremember(prompt, prediction, source, **request)
+                return answer
+            except VALIDATION_ERRORS as exc:
+                print(f"Validation failed: {exc}")
+        metrics.increment(f"{task}.failures")
+        return None
+
+    async def astream_ask(
+        self, task: str, prompt: str, parse: Callable[[str], Any], retries: int, key: str = "long_version"
+    ) -> AsyncIterator[tuple[str, Optional[tuple[Any, str]]]]:
+        """
+        Streaming `aask`: yields the string under `key` as it grows, with a None answer,
+        until the last item which carries the validated answer, or None if all `retries` failed.
+        If the streamed reply turns out invalid, the remaining tries are regular predictions.
+        """
+        metrics.increment(f"{task}.calls")
+        streamed = StreamedString(key)
+        chunks, shown = [], ""
+        request = dict(is_json=True, schema=REPLY_SCHEMAS[task], model=self.model(task))
+        async for chunk in Oracle.astream(prompt, **request):
+            chunks.append(chunk)
+            text = streamed.feed(chunk)
+            if text != shown:
+                shown = text
+                yield text, None
+        source = "".join(chunks)
+        try:
+            answer = parse(source.strip("\n ")), source
+            await Oracle.aremember(prompt, source.strip("\n "), source, **request)
+        except VALIDATION_ERRORS as exc:
+            print(f"Validation failed: {exc}")
+            answer = await self.aask(task, prompt, parse, retries - 1, tried=1) if retries > 1 else None
+        yield shown, answer
+
+    @staticmethod
+    def parse_descriptions(prediction: str) -> dict[str, str]:
+        descriptions = schemas.unwrap(repair_json(prediction), schemas.DESCRIPTIONS)
+        schemas.validate(descriptions, schemas.DESCRIPTIONS)
+        return descriptions
+
+    @staticmethod
+    def parse_options(prediction: str) -> list[str]:
+        values: dict[str, Any] = repair_json(prediction)
+        if isinstance(values, list):  # Just the options
+            values = {"options": values}
+        values = schemas.unwrap(values, schemas.OPTIONS)
+        schemas.validate(values, schemas.OPTIONS)
+        return values["options"]
+
+    @staticmethod
+    def parse_turn(prediction: str) -> dict[str, Any]:
+        turn = schemas.unwrap(repair_json(prediction), schemas.TURN)
+        schemas.validate(turn, schemas.TURN)
+        return turn
+
+    def situation_prompt(self, game_state: GameState) -> str:
+        return self.prompt(
+            game_state,
+            f"Determine the current situation of the {self.story.character}.\n"
             f"The {self.story.character} is currently at this location: {game_state.current_location}\n"
             f"The {self.story.character} has the following goal: {game_state.current_objective}\n"
             f"Return a JSON object describing {self.story.pronouns} current situation. "
-            f"You must include at top-level a 'short_version' under 8 words and a 'long_version' under 20 words."
+            f"You must include at top-level a 'short_version' under 8 words and a 'long_version' under 20 words.",
+        )
+
+    def describe_current_situation(self, game_state: GameState, retries: int = 5) -> tuple[dict[str, str], str]:
+        print("DESCRIBING SITUATION... ", end="")
+        answer = self.ask("situation", self.situation_prompt(game_state), self.parse_descriptions, retries)
+        if answer is None:
+            raise RuntimeError(f"Failed to describe after {retries} tries...")
+        return answer
+
+    def summary_prompt(self, game_state: GameState, beats: list[str]) -> str:
+        return self.prompt(
+            game_state,
+            f"Summarize the story in a few sentences, keeping every important "
+            f"fact, character, item and place the {self.story.character} will need later.\n"
+            f"Summary of the story until now: {game_state.summary or 'Nothing happened yet.'}\n"
+            f"Update it with what happened since:\n" + "\n".join(beats) + "\n"
+            f"Reply with the updated summary only, in under 100 words.",
         )
-        for i in range(retries):
-            try:
-                prediction, source = Oracle.predict(prompt, is_json=True)
-                descriptions = json.loads(prediction)
-                assert "short_version" in descriptions and "long_version" in descriptions
-                return descriptions, source
-            except (JSONDecodeError, AssertionError):
-                continue
-        raise RuntimeError(f"Failed to describe after {retries} tries...")
+
+    async def asummarize(self, game_state: GameState) -> bool:
+        """Folds older history beats into the running summary, keeping prompts short in long games."""
+        fold = game_state.to_fold()
+        if fold is None:
+            return False
+        since, until, beats = fold
+        print("SUMMARIZING... ", end="")
+        prompt = self.summary_prompt(game_state, beats)
+        summary, source = await Oracle.apredict(prompt, model=self.model("summary"))
+        await Oracle.aremember(prompt, summary, source, model=self.model("summary"))
+        return game_state.fold(summary, since, until)
 
     @staticmethod
     def display_information(game_state: GameState) -> str:
         return f"Location: {game_state.current_location}\n" f"Objective: {game_state.current_objective}\n"
 
-    def generate_options(
-        self, situation: str, last_action_results: Optional[str] = None, retries: int = 5
-    ) -> tuple[list[str], str]:
-        prompt: str = (
-            f"{self.pre_prompt} Generate three potential actions the {self.story.character} could do now. "
+    def options_prompt(self, game_state: GameState, situation: str, last_action_results: Optional[str] = None) -> str:
+        return self.prompt(
+            game_state,
+            f"Generate three potential actions the {self.story.character} could do now. "
             f"Was there an action before? {last_action_results}\n"
             f"The current situation for the {self.story.character} is the following:\n"
             f"{situation}\n"
             f"What should {self.story.pronouns} try? Generate three options and reply in valid JSON "
             f"with your three options under the key 'options', as an array of strings. "
             f"Every option should be a short, complete subject-verb-object phrase with an action verb, under 15 words. "
-            "At least one option should be daring, or even perilous. "
+            "At least one option should be daring, or even perilous. ",
             # TODO: Do examples bias too much?
             # f"For example :\n"
             # '{"options": ["She jumps from her hiding place and tries to open the cell door.", '
             # '"She looks around for a solution to the puzzle.", '
             # '"She waits for an opportunity to reason him."]}'
         )
-        for _ in range(retries):
-            try:
-                options, response = Oracle.predict(prompt, is_json=True)
-                values: dict[str, Any] = json.loads(options)
-                if "options" in values:  # "MODEL IS STUPID"
-                    assert type(values["options"]) is list and type(values["options"][0]) is str
-                    return values["options"], response
-            except (JSONDecodeError, AssertionError, IndexError) as exc:
-                print(f"Validation failed: {exc}")
-                continue
-        raise SystemError(f"Failed to generate options after {retries} retries...")
-
-    def describe_action_result(
-        self, game_state: GameState, action: str, retries: int = 5
-    ) -> tuple[dict[str, str], str, int]:
-        print("DESCRIBING ACTION... ", end="")
-        result_score = random.randint(1, 10)
+
+    def generate_options(
+        self, game_state: GameState, situation: str, last_action_results: Optional[str] = None, retries: int = 5
+    ) -> tuple[list[str], str]:
+        answer = self.ask(
+            "options", self.options_prompt(game_state, situation, last_action_results), self.parse_options, retries
+        )
+        if answer is None:
+            raise SystemError(f"Failed to generate options after {retries} retries...")
+        return answer
+
+    async def agenerate_options(
+        self, game_state: GameState, situation: str, last_action_results: Optional[str] = None, retries: int = 5
+    ) -> tuple[list[str], str]:
+        answer = await self.aask(
+            "options", self.options_prompt(game_state, situation, last_action_results), self.parse_options, retries
+        )
+        if answer is None:
+            raise SystemError(f"Failed to generate options after {retries} retries...")
+        return answer
+
+    def outcome(self, result_score: int) -> str:
+        """What a d10 roll means for the action."""
         if result_score > 9:
             result = "This action works even better than expected ! The story will progress a lot with new advantages."
         elif result_score > 5:
@@ -106,59 +262,113 @@ class GameNarrator:
             result = (
                 f"This action fails epic, putting the {self.story.character} in big trouble to address immediately."
             )
+        return result
 
-        prompt = (
-            f"{self.pre_prompt} Determine what happens after this action."
-            f"The story so far:\n{game_state.history_so_far()}"
+    def action_prompt(self, game_state: GameState, action: str, result_score: int) -> str:
+        return self.prompt(
+            game_state,
+            f"Determine what happens after this action.\n"
             f"The {self.story.character} chose to do: '{action}'\n"
-            f"The result determined by a d10 dice roll was {result_score}/10: '{result}'\n"
+            f"The result determined by a d10 dice roll was {result_score}/10: '{self.outcome(result_score)}'\n"
             f"Describe what happens to her next in a maximum of three short sentences."
             f"Return a JSON object describing the results of her action."
-            f"You must include at top-level a 'short_version' under 20 words and a 'long_version' under 100 words."
+            f"You must include at top-level a 'short_version' under 20 words and a 'long_version' under 100 words.",
         )
+
+    @staticmethod
+    def roll() -> int:
+        """Rolls the d10 deciding how well an action goes."""
+        return random.randint(1, 10)
+
+    async def astream_action_result(
+        self, game_state: GameState, action: str, result_score: int, retries: int = 5
+    ) -> AsyncIterator[tuple[str, Optional[tuple[dict[str, str], str, int]]]]:
+        """
+        Describes the result of an action, yielding its 'long_version' as it grows with a None result,
+        until the last item which carries the validated result.
+        """
+        print("DESCRIBING ACTION (STREAMING)... ", end="")
+        prompt = self.action_prompt(game_state, action, result_score)
         gr.Info(f"Simulating your action...")
-        for i in range(retries):
-            try:
-                prediction, source = Oracle.predict(prompt, is_json=True)
-                descriptions = json.loads(prediction)
-                assert "short_version" in descriptions and "long_version" in descriptions
-                print(descriptions)
-                return descriptions, source, result_score
-            except (JSONDecodeError, AssertionError):
-                continue
-        raise RuntimeError(f"Failed to describe after {retries} tries...")
-
-    def current_location(self, game_state: GameState, retries: int = 5) -> tuple[dict[str, str], str]:
-        print("LOCATING... ", end="")
-        gr.Info(f"Locating the {self.story.character}...")
-        prompt = (
-            f"{self.pre_prompt} determine the current location of the {self.story.character} within the story's environment. "
-            f"Given the following story:\n{game_state.history_so_far()}"
+        async for long_version, answer in self.astream_ask("action", prompt, self.parse_descriptions, retries):
+            if answer is None:
+                yield long_version, None
+        if answer is None:
+            raise RuntimeError(f"Failed to describe after {retries} tries...")
+        descriptions, source = answer
+        print(descriptions)
+        yield descriptions["long_version"], (descriptions, source, result_score)
+
+    def turn_prompt(self, game_state: GameState, action: str, result_score: int) -> str:
+        return self.prompt(
+            game_state,
+            f"Play the next turn of the game.\n"
+            f"The {self.story.character} chose to do: '{action}'\n"
+            f"The result determined by a d10 dice roll was {result_score}/10: '{self.outcome(result_score)}'\n"
+            f"Return a JSON object with these keys, in this order:\n"
+            f"- 'short_version': what happens after this action, under 20 words.\n"
+            f"- 'long_version': what happens after this action, in a maximum of three short sentences "
+            f"and under 100 words.\n"
+            f"- 'location': where the {self.story.character} is afterwards, in a few words. "
+            f'Examples: "In the wine cellar", or "On the roof under strong winds", or "In the kitchen".\n'
+            f"- 'objective': the short-term goal of the {self.story.character} afterwards, in a few words. "
+            f'Examples: "Getting out of the room", or "Opening the treasure chest", or "Solving the enigma".\n'
+            f"- 'options': an array of three potential actions the {self.story.character} could do next. "
+            f"Every option should be a short, complete subject-verb-object phrase with an action verb, "
+            f"under 15 words. At least one option should be daring, or even perilous.",
+        )
+
+    async def astream_turn(
+        self, game_state: GameState, action: str, result_score: int, retries: int = 2
+    ) -> AsyncIterator[tuple[str, Optional[tuple[dict[str, Any], str]]]]:
+        """
+        Asks for a whole turn in one reply: action result, location, objective and next options.
+        Streams the 'long_version' like `astream_action_result` until the last item, which carries the turn.
+        Few retries by default, as callers can fall back to step by step calls.
+        """
+        print("PLAYING TURN (STREAMING)... ", end="")
+        prompt = self.turn_prompt(game_state, action, result_score)
+        gr.Info(f"Simulating your action...")
+        async for long_version, answer in self.astream_ask("turn", prompt, self.parse_turn, retries):
+            if answer is None:
+                yield long_version, None
+        if answer is None:
+            raise RuntimeError(f"Failed to play turn after {retries} tries...")
+        print(answer[0])
+        yield answer[0]["long_version"], answer
+
+    def location_prompt(self, game_state: GameState) -> str:
+        return self.prompt(
+            game_state,
+            f"Determine the current location of the {self.story.character} within the story's environment. "
             f'Where is the {self.story.character}? Reply in a few words. Examples: "In the wine cellar", '
             f'or "On the roof under strong winds", or "In the kitchen".'
             f"Return a JSON object describing her current location. "
             f"You must include at top-level a 'short_version' under 8 words "
-            f"and a 'long_version' under 20 words."
+            f"and a 'long_version' under 20 words.",
         )
-        for i in range(retries):
-            try:
-                prediction, source = Oracle.predict(prompt, is_json=True)
-                descriptions = json.loads(prediction)
-                assert "short_version" in descriptions and "long_version" in descriptions
-                return descriptions, source
-            except (JSONDecodeError, AssertionError):
-                continue
-        raise RuntimeError(f"Failed to describe after {retries} tries...")
-
-    def current_objective(self, game_state: GameState) -> tuple[str, str]:
-        print("OBJECTIVE... ", end="")
-        prompt = (
-            f"{self.pre_prompt} Determine the current goal of the {self.story.character}."
-            f"Given the following story :\n{game_state.history_so_far()}"
+
+    async def acurrent_location(self, game_state: GameState, retries: int = 5) -> tuple[dict[str, str], str]:
+        print("LOCATING... ", end="")
+        gr.Info(f"Locating the {self.story.character}...")
+        answer = await self.aask("location", self.location_prompt(game_state), self.parse_descriptions, retries)
+        if answer is None:
+            raise RuntimeError(f"Failed to describe after {retries} tries...")
+        return answer
+
+    def objective_prompt(self, game_state: GameState) -> str:
+        return self.prompt(
+            game_state,
+            f"Determine the current goal of the {self.story.character}. "
             f"What is the short-term goal of the {self.story.character}? Reply in a few words. "
-            f'Examples: "Getting out of the room", or "Opening the treasure chest", or "Solving the enigma".\n'
+            f'Examples: "Getting out of the room", or "Opening the treasure chest", or "Solving the enigma".\n',
         )
+
+    async def acurrent_objective(self, game_state: GameState) -> tuple[str, str]:
+        print("OBJECTIVE... ", end="")
+        prompt = self.objective_prompt(game_state)
         gr.Info(f"Clarifying goal...")
-        prediction, source = Oracle.predict(prompt)
+        prediction, source = await Oracle.apredict(prompt, model=self.model("objective"))
+        await Oracle.aremember(prompt, prediction, source, model=self.model("objective"))
         print(prediction)
         return prediction, source
@@ -1,9 +1,20 @@
+import asyncio
+import enum
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from functools import lru_cache
-from typing import Any, Union
+from typing import Any, AsyncIterator, Coroutine, Optional, Union
+from weakref import WeakSet
 
+import httpx
 import ollama
 
+from model import benchmark
 from model.names import ModelName
+from utils.cache import ResponseCache
+from utils.metrics import metrics
 
 model_preferences = [  # Ordered by storytelling capability, prove me wrong
     # "phi3:mini",  # DEBUG MINI-MODEL
@@ -22,20 +33,212 @@ model_preferences = [  # Ordered by storytelling capability, prove me wrong
 ]
 
 
+# Seconds we accept to wait for a typical reply: when set, `choose_model` benchmarks local models on this host
+# and picks the preferred one within budget. None to choose by preference only.
+LATENCY_BUDGET: Optional[float] = None
+TYPICAL_REPLY_TOKENS = 150
+
+# How many connections the shared async client may open: further requests wait for a free one
+MAX_CONNECTIONS = 4
+
+# How long Ollama keeps the model loaded after a call. Staying loaded also keeps its evaluated prompt prefix,
+# which the next call of the turn reuses as our prompts share the same system prompt, pre-prompt & story so far.
+KEEP_ALIVE = "30m"
+
+# Whether the Ollama server constrains generation to a reply's JSON schema (format=<schema>, Ollama >= 0.5).
+# Otherwise, we only ask for JSON and validate the reply afterwards.
+STRUCTURED_OUTPUTS = False
+
+# Optional on-disk cache of replies, see `enable_cache`
+response_cache: Optional[ResponseCache] = None
+
+
+def enable_cache(path: str = "generated/responses.sqlite", max_bytes: int = 64 * 1024 * 1024) -> ResponseCache:
+    """Serves identical requests from disk: repeated openings become free and replayed sessions deterministic."""
+    global response_cache
+    response_cache = ResponseCache(path, max_bytes)
+    return response_cache
+
+
+@lru_cache(maxsize=1)
+def async_client() -> ollama.AsyncClient:
+    """The pooled client used by `Oracle.apredict`, so all sessions multiplex over a few keep-alive connections."""
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    return ollama.AsyncClient(limits=limits)
+
+
+@lru_cache(maxsize=1)
+def local_models() -> dict[str, str]:
+    """Models available on the Ollama server and their digests, by decreasing number of parameters."""
+    models = ollama.list()
+    return {
+        m["name"]: m.get("digest", "")
+        for m in sorted(models["models"], key=lambda m: m["details"]["parameter_size"], reverse=True)
+    }
+
+
 @lru_cache(maxsize=1)
 def choose_model() -> str:
     print("Choosing model... ", end="")
-    models = ollama.list()
-    local_models = [
-        m["name"] for m in sorted(models["models"], key=lambda m: m["details"]["parameter_size"], reverse=True)
-    ]
+    local = list(local_models())
+    if LATENCY_BUDGET is not None:
+        return choose_fast_model(local)
 
     for choice in model_preferences:
-        if choice in local_models:
+        if choice in local:
             print(f"Found preferred model {choice}!")
             return choice
     print("No preferred model available, returning your local model with highes # of parameters.")
-    return local_models[0]
+    return local[0]
+
+
+def installed(model: str) -> bool:
+    return model in local_models()
+
+
+def choose_fast_model(local: list[str]) -> str:
+    """The preferred model answering within `LATENCY_BUDGET` on this host, or else the fastest one."""
+    candidates = [m for m in model_preferences if m in local] + [m for m in local if m not in model_preferences]
+    speeds = benchmark.measure({m: local_models()[m] for m in candidates})
+    for choice in candidates:
+        if speeds[choice].latency(TYPICAL_REPLY_TOKENS) <= LATENCY_BUDGET:
+            print(f"Found model {choice} within latency budget!")
+            return choice
+    fastest = min(candidates, key=lambda m: speeds[m].latency(TYPICAL_REPLY_TOKENS))
+    print(f"No model within latency budget, returning the fastest: {fastest}.")
+    return fastest
+
+
+class Priority(enum.IntEnum):
+    """Who waits on a call: the player (INTERACTIVE) goes before work they don't see (BACKGROUND)."""
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class Overloaded(RuntimeError):
+    """Raised instead of queueing a call when too many are already waiting."""
+
+
+# Whose calls these are, set by the caller so the scheduler can share the backend fairly
+current_session: ContextVar[str] = ContextVar("current_session", default="")
+current_priority: ContextVar[Priority] = ContextVar("current_priority", default=Priority.INTERACTIVE)
+# Whether the caller's last reply came from the `response_cache`, so `Oracle.remember` needn't write it back
+served_from_cache: ContextVar[bool] = ContextVar("served_from_cache", default=False)
+
+
+async def as_background(coroutine: Coroutine) -> Any:
+    """Runs a coroutine with BACKGROUND priority, e.g. `asyncio.create_task(as_background(...))`."""
+    current_priority.set(Priority.BACKGROUND)
+    return await coroutine
+
+
+class Scheduler:
+    """Admission control in front of the LLM backend.
+
+    At most `limit` calls run at once. Waiting calls are served by priority, then round-robin across sessions,
+    so one busy session can't starve the others. Calls are rejected right away with `Overloaded` once
+    `max_queued` are waiting, or half as many for BACKGROUND calls which are shed first.
+    A BACKGROUND task the player ends up waiting on, e.g. a claimed speculation, can be `promote`d.
+    Queue depth, running calls, rejections and waiting time are reported in `metrics`.
+    """
+
+    def __init__(self, limit: int = MAX_CONNECTIONS, max_queued: int = 64):
+        self.limit = limit
+        self.max_queued = max_queued
+        self.running = 0
+        self._queues: dict[Priority, OrderedDict[str, deque[asyncio.Future]]] = {p: OrderedDict() for p in Priority}
+        self._queued = 0
+        self._waiting: dict[asyncio.Task, tuple[str, Priority, asyncio.Future]] = {}
+        self._promoted: WeakSet[asyncio.Task] = WeakSet()
+
+    def promote(self, task: asyncio.Task) -> None:
+        """Serves the calls of `task` as INTERACTIVE from now on, including the one it may be waiting for."""
+        self._promoted.add(task)
+        if task not in self._waiting:
+            return
+        session, priority, turn = self._waiting[task]
+        if priority != Priority.INTERACTIVE:
+            self._forget(session, priority, turn)
+            self._enqueue(task, session, Priority.INTERACTIVE, turn)
+
+    @asynccontextmanager
+    async def slot(self, session: Optional[str] = None, priority: Optional[Priority] = None):
+        """Waits for the caller's turn to use the backend, by default as the current session and priority."""
+        session = current_session.get() if session is None else session
+        priority = current_priority.get() if priority is None else priority
+        if asyncio.current_task() in self._promoted:
+            priority = Priority.INTERACTIVE
+        if self.running < self.limit and not self._queued:
+            self.running += 1
+        else:
+            threshold = self.max_queued if priority == Priority.INTERACTIVE else self.max_queued // 2
+            if self._queued >= threshold:
+                metrics.increment(f"scheduler.rejected.{priority.name.lower()}")
+                raise Overloaded(f"Too many calls waiting ({self._queued}), try again later.")
+            await self._wait(session, priority)
+        self._report()
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _wait(self, session: str, priority: Priority) -> None:
+        task = asyncio.current_task()
+        turn = asyncio.get_running_loop().create_future()
+        self._enqueue(task, session, priority, turn)
+        start = time.perf_counter()
+        try:
+            await turn  # The slot is handed over by `_release`, which counts us as running
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                self._release()  # We were given the slot just as we got cancelled
+            else:
+                self._forget(*self._waiting[task])  # Maybe promoted meanwhile
+            raise
+        finally:
+            del self._waiting[task]
+            metrics.increment("scheduler.wait_seconds", time.perf_counter() - start)
+
+    def _enqueue(self, task: asyncio.Task, session: str, priority: Priority, turn: asyncio.Future) -> None:
+        self._waiting[task] = session, priority, turn
+        self._queues[priority].setdefault(session, deque()).append(turn)
+        self._queued += 1
+        self._report()
+
+    def _release(self) -> None:
+        """Hands the slot over to the next waiting call, if any."""
+        for queues in self._queues.values():
+            while queues:
+                session, waiting = next(iter(queues.items()))
+                turn = waiting.popleft()
+                del queues[session]
+                if waiting:
+                    queues[session] = waiting  # Back of the line for this session's next call
+                self._queued -= 1
+                if turn.done():  # Cancelled before its task could `_forget` it: try the next one
+                    continue
+                turn.set_result(None)
+                self._report()
+                return
+        self.running -= 1
+        self._report()
+
+    def _forget(self, session: str, priority: Priority, turn: asyncio.Future) -> None:
+        waiting = self._queues[priority].get(session)
+        if waiting is not None and turn in waiting:
+            waiting.remove(turn)
+            self._queued -= 1
+            if not waiting:
+                del self._queues[priority][session]
+        self._report()
+
+    def _report(self) -> None:
+        metrics.set("scheduler.running", self.running)
+        metrics.set("scheduler.queued", self._queued)
+
+
+scheduler = Scheduler()
 
 
 def system_prompt() -> str:
@@ -55,11 +258,20 @@ def system_prompt() -> str:
 
 class Oracle:
     @staticmethod
-    def predict(prompt: str, is_json: bool = False) -> tuple[str, str]:
+    def predict(
+        prompt: str,
+        is_json: bool = False,
+        schema: Optional[dict[str, Any]] = None,
+        model: Optional[str] = None,
+        fresh: bool = False,
+    ) -> tuple[str, str]:
         """
         Returns a prediction and its raw source.
         :param prompt: input
         :param is_json: if true return Json stp
+        :param schema: JSON schema the reply should follow, enforced by the server if `STRUCTURED_OUTPUTS`
+        :param model: the model to ask, by default `choose_model()`
+        :param fresh: whether to skip the response cache, e.g. when retrying after an invalid reply
         :return: a tuple: prediction, raw response.
         """
         # VERBOSE PROMPT ALERTING
@@ -67,9 +279,89 @@ class Oracle:
         # from prompts import PRE_PROMPT
         # prompt_view = prompt.removeprefix(PRE_PROMPT)
         # gr.Info(f"Answering prompt \"" + prompt_view[:80] + "[...]" + prompt_view[-20:] + "\"")
-        response: Union[str, dict[str, Any]] = ollama.chat(
-            model=choose_model(),
-            format="json" if is_json else "",
+        request = Oracle.request(prompt, is_json, schema, model)
+        cached = response_cache.get(request) if response_cache is not None and not fresh else None
+        served_from_cache.set(cached is not None)
+        if cached is not None:
+            return cached
+        response: Union[str, dict[str, Any]] = ollama.chat(**request)
+        return Oracle.reply(request, response)
+
+    @staticmethod
+    async def apredict(
+        prompt: str,
+        is_json: bool = False,
+        schema: Optional[dict[str, Any]] = None,
+        model: Optional[str] = None,
+        fresh: bool = False,
+    ) -> tuple[str, str]:
+        """
+        Asynchronous `predict`, sent through the pooled `async_client()` instead of blocking a worker thread,
+        once the `scheduler` lets it.
+        :param prompt: input
+        :param is_json: if true return Json stp
+        :param schema: JSON schema the reply should follow, enforced by the server if `STRUCTURED_OUTPUTS`
+        :param model: the model to ask, by default `choose_model()`
+        :param fresh: whether to skip the response cache, e.g. when retrying after an invalid reply
+        :return: a tuple: prediction, raw response.
+        """
+        request = Oracle.request(prompt, is_json, schema, model)
+        if (cached := await Oracle.lookup(request, fresh)) is not None:
+            return cached
+        async with scheduler.slot():
+            response: Union[str, dict[str, Any]] = await async_client().chat(**request)
+        return Oracle.reply(request, response)
+
+    @staticmethod
+    async def astream(
+        prompt: str,
+        is_json: bool = False,
+        schema: Optional[dict[str, Any]] = None,
+        model: Optional[str] = None,
+        fresh: bool = False,
+    ) -> AsyncIterator[str]:
+        """
+        Streaming `apredict`: yields the reply chunk by chunk as the model generates it,
+        through the pooled `async_client()` once the `scheduler` lets it.
+        :param prompt: input
+        :param is_json: if true return Json stp
+        :param schema: JSON schema the reply should follow, enforced by the server if `STRUCTURED_OUTPUTS`
+        :param model: the model to ask, by default `choose_model()`
+        :param fresh: whether to skip the response cache, e.g. when retrying after an invalid reply
+        :return: an async iterator over the reply's chunks.
+        """
+        request = Oracle.request(prompt, is_json, schema, model)
+        if (cached := await Oracle.lookup(request, fresh)) is not None:
+            yield cached[1]
+            return
+        chunks = []
+        async with scheduler.slot():
+            async for part in await async_client().chat(**request, stream=True):
+                chunks.append(part["message"]["content"])
+                yield chunks[-1]
+        Oracle.reply(request, {"message": {"content": "".join(chunks)}})
+
+    @staticmethod
+    async def lookup(request: dict[str, Any], fresh: bool = False) -> Optional[tuple[str, str]]:
+        """The cached reply to this request if any, read in a worker thread to keep SQLite off the event loop."""
+        cached = None
+        if response_cache is not None and not fresh:
+            cached = await asyncio.to_thread(response_cache.get, request)
+        served_from_cache.set(cached is not None)
+        return cached
+
+    @staticmethod
+    def request(
+        prompt: str, is_json: bool = False, schema: Optional[dict[str, Any]] = None, model: Optional[str] = None
+    ) -> dict[str, Any]:
+        """The chat request sent to Ollama for this prompt."""
+        if schema is not None and STRUCTURED_OUTPUTS:
+            reply_format = schema
+        else:
+            reply_format = "json" if is_json or schema is not None else ""
+        return dict(
+            model=model or choose_model(),
+            format=reply_format,
             messages=[
                 {
                     "role": "system",
@@ -83,9 +375,45 @@ class Oracle:
                 },
             ],
             options={"temperature": 0.8},
+            keep_alive=KEEP_ALIVE,
         )
+
+    @staticmethod
+    def remember(
+        prompt: str,
+        content: str,
+        source: str,
+        is_json: bool = False,
+        schema: Optional[dict[str, Any]] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        """
+        Caches a reply to this prompt if the cache is enabled, once the caller accepted it.
+        Invalid replies must not be cached, as retrying sends the very same request.
+        Replies just served from the cache aren't written again.
+        """
+        if response_cache is not None and not served_from_cache.get():
+            response_cache.put(Oracle.request(prompt, is_json, schema, model), content, source)
+
+    @staticmethod
+    async def aremember(
+        prompt: str,
+        content: str,
+        source: str,
+        is_json: bool = False,
+        schema: Optional[dict[str, Any]] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        """Asynchronous `remember`, writing to SQLite in a worker thread."""
+        if response_cache is not None and not served_from_cache.get():
+            await asyncio.to_thread(Oracle.remember, prompt, content, source, is_json, schema, model)
+
+    @staticmethod
+    def reply(request: dict[str, Any], response: Union[str, dict[str, Any]]) -> tuple[str, str]:
+        """Extracts the prediction and its raw source from a chat response."""
         response = response["message"]
-        print(f"\n\n\n{prompt}\n -> {response}")
+        print(f"\n\n\n{request['messages'][-1]['content']}\n -> {response}")
         content = response["content"] if "content" in response else response
         content = content.strip("\n ")
-        return content, response["content"] if "content" in response else response
+        source = response["content"] if "content" in response else response
+        return content, source
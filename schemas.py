@@ -0,0 +1,80 @@
+"""JSON schemas of the oracle's structured replies, and a minimal validator for them."""
+
+from typing import Any
+
+from utils.metrics import metrics
+
+DESCRIPTIONS: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "short_version": {"type": "string", "minLength": 1},
+        "long_version": {"type": "string", "minLength": 1},
+    },
+    "required": ["short_version", "long_version"],
+}
+
+OPTIONS: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "options": {"type": "array", "items": {"type": "string", "minLength": 1}, "minItems": 3},
+    },
+    "required": ["options"],
+}
+
+TURN: dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "short_version": {"type": "string", "minLength": 1},
+        "long_version": {"type": "string", "minLength": 1},
+        "location": {"type": "string", "minLength": 1},
+        "objective": {"type": "string", "minLength": 1},
+        "options": {
+            "type": "array",
+            "items": {"type": "string", "minLength": 1},
+            "minItems": 3,
+            "maxItems": 3,
+        },
+    },
+    "required": ["short_version", "long_version", "location", "objective", "options"],
+}
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+
+def unwrap(instance: Any, schema: dict[str, Any]) -> Any:
+    """Finds the object with the schema's required keys when it was nested one level down, e.g. {"result": {...}}."""
+    required = schema.get("required", [])
+    if isinstance(instance, dict) and not all(key in instance for key in required):
+        nested = [v for v in instance.values() if isinstance(v, dict) and all(key in v for key in required)]
+        if len(nested) == 1:
+            metrics.increment("json.unwrapped")
+            return nested[0]
+    return instance
+
+
+def validate(instance: Any, schema: dict[str, Any], path: str = "$") -> None:
+    """Checks an instance against the subset of JSON schema used above, raising AssertionError where it fails."""
+    expected = schema.get("type")
+    if expected is not None:
+        assert isinstance(instance, _TYPES[expected]), f"{path} should be of type {expected}"
+    if isinstance(instance, dict):
+        for key in schema.get("required", []):
+            assert key in instance, f"{path} misses required key '{key}'"
+        for key, subschema in schema.get("properties", {}).items():
+            if key in instance:
+                validate(instance[key], subschema, f"{path}.{key}")
+    elif isinstance(instance, list):
+        assert len(instance) >= schema.get("minItems", 0), f"{path} has too few items"
+        assert len(instance) <= schema.get("maxItems", len(instance)), f"{path} has too many items"
+        if "items" in schema:
+            for i, item in enumerate(instance):
+                validate(item, schema["items"], f"{path}[{i}]")
+    elif isinstance(instance, str):
+        assert len(instance) >= schema.get("minLength", 0), f"{path} is too short"
@@ -0,0 +1,74 @@
+"""Speculative pre-generation of action results, while the player is still reading their options."""
+
+import asyncio
+from typing import Optional
+from weakref import WeakKeyDictionary
+
+from narrator import GameNarrator
+from oracle import Priority, current_priority, scheduler
+from state import GameState
+
+
+class Speculator:
+    """Pre-rolls and pre-generates the result of every offered option, keeping only the one the player picks.
+
+    Speculations are bound to the history they were started from, and to their game state:
+    they are dropped once the state moves on or is evicted from the session store.
+    """
+
+    def __init__(self, narrator: GameNarrator, retries: int = 5):
+        self.narrator = narrator
+        self.retries = retries
+        self._pending: WeakKeyDictionary[GameState, tuple[int, dict[str, tuple[int, asyncio.Task]]]] = (
+            WeakKeyDictionary()
+        )
+
+    def start(self, game_state: GameState, options: list[str]) -> None:
+        """Starts generating the result of each option in the background, replacing former speculations."""
+        self.cancel(game_state)
+        speculations = {}
+        for option in options:
+            result_score = self.narrator.roll()
+            outcome = asyncio.create_task(self.describe(game_state, option, result_score))
+            outcome.add_done_callback(ignore_failure)
+            speculations[option] = (result_score, outcome)
+        self._pending[game_state] = (len(game_state.history), speculations)
+
+    async def describe(self, game_state: GameState, action: str, result_score: int) -> tuple[dict[str, str], str, int]:
+        """
+        A quiet `astream_action_result`: the player shouldn't be notified of what they may never choose.
+        Runs at BACKGROUND priority, set here rather than with `as_background` so that a speculation cancelled
+        before it started leaves no coroutine behind, never awaited.
+        """
+        current_priority.set(Priority.BACKGROUND)
+        prompt = self.narrator.action_prompt(game_state, action, result_score)
+        answer = await self.narrator.aask("action", prompt, self.narrator.parse_descriptions, self.retries)
+        if answer is None:
+            raise RuntimeError(f"Failed to speculate after {self.retries} tries...")
+        descriptions, source = answer
+        return descriptions, source, result_score
+
+    def claim(self, game_state: GameState, action: str) -> Optional[tuple[int, asyncio.Task]]:
+        """
+        Takes the speculation for the chosen action, cancelling the others.
+        As the player now waits on it, its remaining calls no longer yield to other players' interactive ones.
+        :return: None if there is no valid speculation for it, else a tuple: its d10 roll, its pending result.
+        """
+        history_length, speculations = self._pending.get(game_state, (-1, {}))
+        claimed = speculations.pop(action, None) if history_length == len(game_state.history) else None
+        self.cancel(game_state)
+        if claimed is not None:
+            scheduler.promote(claimed[1])
+        print(f"Speculation {'hit' if claimed else 'miss'}: {action}")
+        return claimed
+
+    def cancel(self, game_state: GameState) -> None:
+        _, speculations = self._pending.pop(game_state, (-1, {}))
+        for _, outcome in speculations.values():
+            outcome.cancel()
+
+
+def ignore_failure(outcome: asyncio.Task) -> None:
+    """Marks a failed speculation as handled: whoever claims it falls back to a regular generation."""
+    if not outcome.cancelled():
+        outcome.exception()
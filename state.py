@@ -1,23 +1,133 @@
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough token count, good enough for budgeting prompts (~4 characters per token in english)."""
+    return len(text) // 4 + 1
 
 
 class GameState:
-    history: list = []
+    """The state of one game: its history, current location and objective.
 
-    def __init__(self, introduction: str, location: str = "The first room", objective: str = "Get out of her room"):
-        self.history.append(introduction)
+    Only the introduction and the latest beats of history are kept verbatim in prompts:
+    older beats are folded into a running `summary`, see `to_fold` and `fold`.
+    """
+
+    def __init__(
+        self,
+        introduction: str,
+        location: str = "The first room",
+        objective: str = "Get out of her room",
+        recent_beats: int = 8,
+        max_history_tokens: int = 1500,
+    ):
+        self.history: list[str] = [introduction]
         self.current_location: str = location
         self.current_objective: str = objective
+        self.size: int = len(introduction)  # Characters held in history, to bound memory
+        self.recent_beats = recent_beats
+        self.max_history_tokens = max_history_tokens
+        self.summary: str = ""
+        self.folded: int = 1  # History before this index is in the summary (except the introduction)
 
     def history_so_far(self) -> str:
-        return "\n".join(x for x in self.history) + "\n"
+        recap = [f"In short, what happened next: {self.summary}"] if self.summary else []
+        return "\n".join(x for x in [self.history[0], *recap, *self.history[self.folded :]]) + "\n"
+
+    def to_fold(self) -> Optional[tuple[int, int, list[str]]]:
+        """
+        The beats that should now be folded into the summary, if any.
+        We keep the last `recent_beats` verbatim, or fewer if they exceed `max_history_tokens`.
+        :return: None, or a tuple: index of first beat to fold, index after the last one, beats to fold.
+        """
+        end, tokens = len(self.history), 0
+        while end > self.folded and len(self.history) - end < self.recent_beats:
+            tokens += estimate_tokens(self.history[end - 1])
+            if tokens > self.max_history_tokens and len(self.history) - end >= 2:  # Keep at least the last result
+                break
+            end -= 1
+        if end <= self.folded:
+            return None
+        return self.folded, end, self.history[self.folded : end]
+
+    def fold(self, summary: str, since: int, until: int) -> bool:
+        """Folds beats `since` to `until` into a new summary, unless the state moved on since they were picked."""
+        if since != self.folded or until > len(self.history):
+            return False
+        self.summary = summary
+        self.folded = until
+        return True
 
     def update(self, steps: list[str] = None, location: Optional[str] = None, objective: Optional[str] = None):
         if type(steps) is str:
             raise ValueError("Expecting array!")
         if steps is not None:
             self.history.extend(steps)
+            self.size += sum(len(s) for s in steps)
         if location is not None:
             self.current_location = location
         if objective is not None:
             self.current_objective = objective
+
+
+class SessionStore:
+    """One GameState per player session, created on first access.
+
+    Sessions idle for more than `idle_timeout` seconds are dropped, and least recently used ones are evicted
+    whenever there are more than `max_sessions` or their histories exceed `max_chars` in total.
+    Evicted states are passed to `on_evict`, e.g. to cancel the work still pending for them.
+    """
+
+    def __init__(
+        self,
+        new_state: Callable[[], GameState],
+        max_sessions: int = 500,
+        idle_timeout: float = 3600,
+        max_chars: int = 50_000_000,
+        on_evict: Optional[Callable[[GameState], None]] = None,
+    ):
+        self.new_state = new_state
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_chars = max_chars
+        self.on_evict = on_evict
+        self._states: OrderedDict[str, tuple[GameState, float]] = OrderedDict()  # Least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, session: str) -> GameState:
+        """The state of this session, starting a new game if it is unknown or was evicted."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.pop(session, (None, now))[0]
+            if state is None:
+                state = self.new_state()
+            self._states[session] = (state, now)
+            evicted = self._evict(now)
+        if self.on_evict is not None:
+            for old_state in evicted:
+                self.on_evict(old_state)
+        return state
+
+    def _evict(self, now: float) -> list[GameState]:
+        evicted = []
+        while self._states:
+            oldest, (state, last_seen) = next(iter(self._states.items()))
+            if now - last_seen <= self.idle_timeout:
+                break
+            del self._states[oldest]
+            evicted.append(state)
+        total = sum(state.size for state, _ in self._states.values())
+        while len(self._states) > 1 and (len(self._states) > self.max_sessions or total > self.max_chars):
+            _, (state, _) = self._states.popitem(last=False)
+            total -= state.size
+            evicted.append(state)
+        return evicted
+
+    def __contains__(self, session: str) -> bool:
+        return session in self._states
+
+    def __len__(self) -> int:
+        return len(self._states)
@@ -1,4 +1,6 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from model.names import ModelName
 
 
 @dataclass
@@ -29,12 +31,18 @@ class Story:
     is_voice_third_person: bool = True
     # TODO: Other ideas for story parameters
     ambiance: str = "heroic fantasy"
+    """Models routing some narrator tasks (e.g. "location") away from the storytelling model, see TINY_EXTRACTION."""
+    models: dict[str, str] = field(default_factory=dict)
 
     @property
     def voice(self):
         return "third person" if self.is_voice_third_person else "first person"
 
 
+# Extracting a few words needs no storyteller: route those tasks to a tiny, much faster model
+TINY_EXTRACTION: dict[str, str] = {"location": ModelName.tiny, "objective": ModelName.tiny}
+
+
 if __name__ == "__main__":
     story = Story()
     PRE_PROMPT = (
@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+import gradio as gr
+
+from achievements.logic import check_sequence_achievements, render_achievements, update_achievements
+
+
+def rolled(state: dict, *rolls: int) -> set[str]:
+    state["rolls"].extend(rolls)
+    check_sequence_achievements(state)
+    return set(state["achievements"])
+
+
+class TestSequenceAchievements(TestCase):
+    def setUp(self):
+        self.state = {"rolls": [], "achievements": {}}
+
+    def test_tens_are_zeros(self):
+        self.assertEqual(rolled(self.state, 1, 10), set())
+        self.assertEqual(rolled(self.state, 10), {"seq_00"})
+        self.assertEqual(rolled(self.state, 10), {"seq_00", "seq_000"})
+
+    def test_incremental(self):
+        for roll in [4, 2]:
+            self.assertEqual(rolled(self.state, roll), set())
+        self.assertEqual(rolled(self.state, 10), {"seq_420"})
+        self.assertEqual(rolled(self.state, 4, 2, 1, 3), {"seq_420", "seq_421", "seq_13"})
+
+    def test_new_game(self):
+        rolled(self.state, 6, 6)
+        self.state["rolls"] = []
+        self.assertEqual(rolled(self.state, 6), set())
+
+
+class TestAchievementsPanel(TestCase):
+    def test_skipped_until_unlocked(self):
+        state = {"rolls": [5], "achievements": {}}
+        panel = update_achievements([["Open the door", None]], state)
+        self.assertTrue(panel.startswith("# 1/"))
+        self.assertEqual(update_achievements([["Open the door", None], [None, "It opens"]], state), gr.skip())
+
+        state["rolls"].append(8)
+        self.assertIn("Lucky 8", update_achievements([["Open the door", None], [None, "It opens"]], state))
+
+    def test_memoized(self):
+        render_achievements.cache_clear()
+        self.assertIs(
+            render_achievements(frozenset({"hello", "roll_8"})), render_achievements(frozenset({"roll_8", "hello"}))
+        )
+        self.assertEqual(render_achievements.cache_info().hits, 1)
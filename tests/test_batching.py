@@ -0,0 +1,44 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from visuals.batching import Batcher
+from visuals.jobs import Superseded
+
+
+def params(prompt: str, steps: int = 4) -> dict:
+    return {"prompt": prompt, "style": "", "preset": "turbo", "model": "tiny", "steps": steps, "seed": 0}
+
+
+class TestBatcher(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.batches = []
+
+    async def render_batch(self, batch, stop):
+        self.batches.append([p["prompt"] for p in batch])
+        return [p["prompt"].upper() for p in batch]
+
+    async def test_batched_and_fanned_out(self):
+        batcher = Batcher(self.render_batch, window=0.01)
+        results = await asyncio.gather(*(batcher.render(params(p)) for p in ["a", "b", "c"]))
+        self.assertEqual(results, ["A", "B", "C"])
+        self.assertEqual(self.batches, [["a", "b", "c"]])
+
+    async def test_grouped_by_steps(self):
+        batcher = Batcher(self.render_batch, window=0.01)
+        results = await asyncio.gather(batcher.render(params("a", 1)), batcher.render(params("b", 4)))
+        self.assertEqual(results, ["A", "B"])
+        self.assertCountEqual(self.batches, [["a"], ["b"]])
+
+    async def test_max_batch(self):
+        batcher = Batcher(self.render_batch, window=10, max_batch=2)
+        results = await asyncio.gather(batcher.render(params("a")), batcher.render(params("b")))
+        self.assertEqual(results, ["A", "B"])
+        self.assertEqual(self.batches, [["a", "b"]])
+
+    async def test_stale_not_rendered(self):
+        batcher = Batcher(self.render_batch, window=0.01)
+        stale, fresh = batcher.render(params("a"), stop=lambda: True), batcher.render(params("b"))
+        results = await asyncio.gather(stale, fresh, return_exceptions=True)
+        self.assertIsInstance(results[0], Superseded)
+        self.assertEqual(results[1], "B")
+        self.assertEqual(self.batches, [["b"]])
@@ -0,0 +1,24 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from model.benchmark import ModelSpeed, measure
+
+
+class TestBenchmark(TestCase):
+    def test_latency(self):
+        speed = ModelSpeed("tiny", "abc", time_to_first_token=0.5, tokens_per_second=100)
+        self.assertAlmostEqual(speed.latency(150), 2.0)
+
+    def test_cached_measures(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "host.json")
+            with open(path, "w") as file:
+                json.dump(
+                    {"tiny": {"model": "tiny", "digest": "abc", "time_to_first_token": 0.1, "tokens_per_second": 90}},
+                    file,
+                )
+
+            speeds = measure({"tiny": "abc"}, path)  # Would reach Ollama if not served from cache
+            self.assertEqual(speeds["tiny"].tokens_per_second, 90)
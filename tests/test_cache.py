@@ -0,0 +1,104 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from PIL import Image
+
+import oracle
+from oracle import Oracle
+from utils.cache import ImageCache, ResponseCache
+
+
+def request(prompt: str) -> dict:
+    return {"model": "tiny", "format": "json", "messages": [{"role": "user", "content": prompt}], "options": {}}
+
+
+class TestResponseCache(TestCase):
+    def test_hit_and_miss(self):
+        with TemporaryDirectory() as directory:
+            cache = ResponseCache(os.path.join(directory, "responses.sqlite"))
+            self.assertIsNone(cache.get(request("Once upon a time")))
+            cache.put(request("Once upon a time"), "a princess", " a princess\n")
+            self.assertEqual(cache.get(request("Once upon a time")), ("a princess", " a princess\n"))
+            self.assertIsNone(cache.get(request("Once upon another time")))
+            self.assertAlmostEqual(cache.hit_rate, 1 / 3)
+
+    def test_transport_settings_ignored(self):
+        with TemporaryDirectory() as directory:
+            cache = ResponseCache(os.path.join(directory, "responses.sqlite"))
+            cache.put({**request("Once upon a time"), "keep_alive": "30m"}, "a princess", "a princess")
+            self.assertIsNotNone(cache.get({**request("Once upon a time"), "keep_alive": "5m"}))
+            self.assertIsNone(cache.get({**request("Once upon a time"), "options": {"temperature": 0}}))
+
+    def test_lru_eviction(self):
+        with TemporaryDirectory() as directory:
+            cache = ResponseCache(os.path.join(directory, "responses.sqlite"), max_bytes=25)
+            cache.put(request("first"), "x" * 10, "")
+            cache.put(request("second"), "y" * 10, "")
+            cache.get(request("first"))  # Now most recently used
+            cache.put(request("third"), "z" * 10, "")
+            self.assertIsNotNone(cache.get(request("first")))
+            self.assertIsNone(cache.get(request("second")))
+            self.assertEqual(len(cache), 2)
+
+    def test_replaced_counted_once(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, "responses.sqlite")
+            cache = ResponseCache(path, max_bytes=25)
+            cache.put(request("first"), "x" * 10, "")
+            cache.put(request("first"), "x" * 10, "")
+            cache.put(request("second"), "y" * 10, "")
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(ResponseCache(path)._bytes, 20)  # Running total restored on open
+
+
+class TestOracleCache(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        oracle.enable_cache(os.path.join(self.directory.name, "responses.sqlite"))
+        oracle.served_from_cache.set(False)
+
+    def tearDown(self):
+        oracle.response_cache = None
+        self.directory.cleanup()
+
+    def test_remembered_replies_served(self):
+        Oracle.remember("Once upon a time", "a princess", " a princess\n", is_json=True, model="tiny")
+        self.assertEqual(
+            Oracle.predict("Once upon a time", is_json=True, model="tiny"), ("a princess", " a princess\n")
+        )
+        self.assertEqual(oracle.response_cache.hits, 1)
+
+    def test_hits_not_written_back(self):
+        Oracle.remember("Once upon a time", "a princess", "a princess", model="tiny")
+        Oracle.predict("Once upon a time", model="tiny")
+        Oracle.remember("Once upon a time", "a knight", "a knight", model="tiny")
+        self.assertEqual(Oracle.predict("Once upon a time", model="tiny"), ("a princess", "a princess"))
+
+
+def params(prompt: str, seed: int = 0) -> dict:
+    return {"prompt": prompt, "style": "", "model": "tiny", "steps": 1, "seed": seed}
+
+
+class TestImageCache(TestCase):
+    def test_hit_and_miss(self):
+        with TemporaryDirectory() as directory:
+            cache = ImageCache(directory)
+            self.assertIsNone(cache.get(params("a princess")))
+            cache.put(params("a princess"), Image.new("RGB", (8, 8), "red"))
+            self.assertEqual(cache.get(params("a princess")).getpixel((0, 0)), (255, 0, 0))
+            self.assertIsNone(cache.get(params("a princess", seed=1)))
+            self.assertEqual(len(ImageCache(directory)), 1)  # Persisted
+
+    def test_lru_eviction(self):
+        with TemporaryDirectory() as directory:
+            cache = ImageCache(directory)
+            cache.put(params("first"), Image.new("RGB", (8, 8), "red"))
+            cache.max_bytes = 2 * os.path.getsize(cache.path(cache.key(params("first"))))
+            cache.put(params("second"), Image.new("RGB", (8, 8), "red"))
+            cache.get(params("first"))  # Now most recently used
+            cache.put(params("third"), Image.new("RGB", (8, 8), "red"))
+            self.assertIsNotNone(cache.get(params("first")))
+            self.assertIsNone(cache.get(params("second")))
+            self.assertEqual(len(cache), 2)
+
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from unittest import IsolatedAsyncioTestCase
+
+from visuals.jobs import LatestWins, Superseded
+
+
+def rendered(result: str):
+    async def render(_):
+        return result
+
+    return render
+
+
+class TestLatestWins(IsolatedAsyncioTestCase):
+    async def test_debounced(self):
+        jobs, calls = LatestWins(debounce=0.01), []
+
+        def render(name: str):
+            calls.append(name)
+            return name
+
+        results = await asyncio.gather(
+            *(jobs.run("alice", lambda _, n=n: asyncio.to_thread(render, n)) for n in ["a", "b", "c"])
+        )
+
+        self.assertEqual(results, [None, None, "c"])
+        self.assertEqual(calls, ["c"])
+        self.assertEqual(len(jobs), 0)
+
+    async def test_keys_independent(self):
+        jobs = LatestWins(debounce=0)
+        results = await asyncio.gather(jobs.run("alice", rendered("a")), jobs.run("bob", rendered("b")))
+        self.assertEqual(results, ["a", "b"])
+
+    async def test_superseded_while_rendering(self):
+        jobs, started, steps = LatestWins(debounce=0), threading.Event(), []
+
+        def slow(stale):
+            started.set()
+            for step in range(500):
+                if stale():
+                    raise Superseded
+                steps.append(step)
+                threading.Event().wait(0.001)
+            return "slow"
+
+        first = asyncio.create_task(jobs.run("alice", lambda stale: asyncio.to_thread(slow, stale)))
+        await asyncio.to_thread(started.wait)
+        second = await jobs.run("alice", rendered("fast"))
+
+        self.assertIsNone(await first)
+        self.assertEqual(second, "fast")
+        self.assertLess(len(steps), 500)
+
+    async def test_stale_result_discarded(self):
+        jobs, started, release = LatestWins(debounce=0), threading.Event(), threading.Event()
+
+        def stubborn(_):
+            started.set()
+            release.wait()
+            return "stale"
+
+        first = asyncio.create_task(jobs.run("alice", lambda stale: asyncio.to_thread(stubborn, stale)))
+        await asyncio.to_thread(started.wait)
+        second = asyncio.create_task(jobs.run("alice", rendered("fresh")))
+        await asyncio.sleep(0.01)
+        release.set()
+
+        self.assertIsNone(await first)
+        self.assertEqual(await second, "fresh")
@@ -0,0 +1,32 @@
+import random
+from unittest import TestCase
+
+from achievements.matcher import Matcher
+
+
+class TestMatcher(TestCase):
+    def test_counts(self):
+        matcher = Matcher(["he", "she", "his", "hers", "delve"])
+        _, counts = matcher.scan("ushers delve into his history")
+        self.assertEqual(counts, {"she": 1, "he": 1, "hers": 1, "delve": 1, "his": 2})
+
+    def test_overlapping(self):
+        _, counts = Matcher(["00", "000"]).scan("00000")
+        self.assertEqual(counts, {"00": 4, "000": 3})
+
+    def test_resume(self):
+        matcher = Matcher(["delve", "realm"])
+        state, counts = matcher.scan("let's del")
+        state, counts = matcher.scan("ve into the re", state, counts)
+        _, counts = matcher.scan("alm", state, counts)
+        self.assertEqual(counts, {"delve": 1, "realm": 1})
+
+    def test_like_brute_force(self):
+        rng = random.Random(42)
+        patterns = ["".join(rng.choices("abc", k=rng.randint(1, 4))) for _ in range(30)]
+        text = "".join(rng.choices("abcd", k=500))
+        matcher = Matcher(patterns)
+        _, counts = matcher.scan(text)
+        for pattern in matcher.patterns:
+            expected = sum(text.startswith(pattern, i) for i in range(len(text)))
+            self.assertEqual(counts[pattern], expected, pattern)
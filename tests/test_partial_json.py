@@ -0,0 +1,63 @@
+import json
+from json import JSONDecodeError
+from unittest import TestCase
+
+from utils.partial_json import StreamedString, repair_json
+
+
+class TestStreamedString(TestCase):
+    REPLY = json.dumps(
+        {
+            "short_version": "She opens the door",
+            "nested": {"long_version": "not this one"},
+            "long_version": 'She pushes, the door "creaks"\nand opens. Café!',
+        }
+    )
+
+    def test_whole_reply(self):
+        streamed = StreamedString("long_version")
+        self.assertEqual(streamed.feed(self.REPLY), json.loads(self.REPLY)["long_version"])
+        self.assertTrue(streamed.done)
+
+    def test_char_by_char(self):
+        streamed = StreamedString("long_version")
+        values = [streamed.feed(char) for char in self.REPLY]
+        self.assertEqual(values[-1], json.loads(self.REPLY)["long_version"])
+        self.assertTrue(all(values[-1].startswith(v) for v in values))
+        self.assertEqual(values[len(self.REPLY) // 4], "")  # Still in short_version
+
+    def test_escaped_emoji(self):
+        streamed = StreamedString("long_version")
+        values = [streamed.feed(char) for char in json.dumps({"long_version": "ok 😈"})]
+        self.assertEqual(values[-1], "ok 😈")
+        self.assertTrue(all(v.isprintable() for v in values))  # Never a lone half of the emoji
+
+    def test_partial(self):
+        streamed = StreamedString("long_version")
+        self.assertEqual(streamed.feed('{"long_version": "Once upon a ti'), "Once upon a ti")
+        self.assertFalse(streamed.done)
+
+
+class TestRepairJson(TestCase):
+    def test_valid(self):
+        self.assertEqual(repair_json('{"a": [1, 2]}'), {"a": [1, 2]})
+
+    def test_stray_prefix_and_suffix(self):
+        reply = 'Here is your JSON:\n```json\n{"options": ["Run", "Hide", "Sing"]}\n```\nHave fun!'
+        self.assertEqual(repair_json(reply), {"options": ["Run", "Hide", "Sing"]})
+
+    def test_trailing_commas(self):
+        self.assertEqual(repair_json('{"a": [1, 2, ], "b": "c",}'), {"a": [1, 2], "b": "c"})
+
+    def test_truncated(self):
+        self.assertEqual(
+            repair_json('{"short_version": "She runs", "long_version": "She runs to the do'),
+            {"short_version": "She runs", "long_version": "She runs to the do"},
+        )
+        self.assertEqual(repair_json('{"a": "b", "c'), {"a": "b"})
+        self.assertEqual(repair_json('{"a": "b", "c": '), {"a": "b"})
+        self.assertEqual(repair_json('{"a": {"b": [1, 2'), {"a": {"b": [1, 2]}})
+
+    def test_not_json(self):
+        with self.assertRaises(JSONDecodeError):
+            repair_json("Once upon a time, a princess...")
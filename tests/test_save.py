@@ -0,0 +1,48 @@
+import gzip
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from PIL import Image
+
+from utils.save import GenerationLog
+
+
+def read(directory: str) -> list[dict]:
+    records = []
+    for name in sorted(os.listdir(directory)):
+        with (gzip.open if name.endswith(".gz") else open)(os.path.join(directory, name), "rt") as file:
+            records.extend(json.loads(line) for line in file)
+    return records
+
+
+class TestGenerationLog(TestCase):
+    def test_append(self):
+        with TemporaryDirectory() as directory:
+            log = GenerationLog(directory)
+            log.append({"prompt": "Once upon a time", "response": "a princess"})
+            log.append({"prompt": "Once upon a time", "response": "a knight"})
+            log.close()
+            records = read(directory)
+            self.assertEqual([r["response"] for r in records], ["a princess", "a knight"])
+            self.assertIn("time", records[0])
+            self.assertEqual(log.segments, 1)
+
+    def test_rotation_compressed(self):
+        with TemporaryDirectory() as directory:
+            log = GenerationLog(directory, max_bytes=100, compress=True)
+            for i in range(5):
+                log.append({"prompt": f"prompt {i}", "response": "x" * 40})
+            log.close()
+            self.assertEqual(len(os.listdir(directory)), 5)
+            self.assertEqual([r["prompt"] for r in read(directory)], [f"prompt {i}" for i in range(5)])
+
+    def test_save_image(self):
+        with TemporaryDirectory() as directory:
+            log = GenerationLog(directory)
+            path = os.path.join(directory, "images", "princess.png")
+            log.save_image(Image.new("RGB", (8, 8), "red"), path)
+            log.flush()
+            self.assertTrue(os.path.exists(path))
+            log.close()
@@ -0,0 +1,92 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from oracle import Overloaded, Priority, Scheduler
+
+
+class TestScheduler(IsolatedAsyncioTestCase):
+    async def call(self, scheduler: Scheduler, session: str, priority: Priority, name: str, order: list[str]):
+        async with scheduler.slot(session, priority):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def test_fair_and_prioritized(self):
+        scheduler, order = Scheduler(limit=1), []
+        calls = [asyncio.create_task(self.call(scheduler, "alice", Priority.INTERACTIVE, "alice0", order))]
+        await asyncio.sleep(0)
+        for session, priority, name in [
+            ("alice", Priority.INTERACTIVE, "alice1"),
+            ("alice", Priority.INTERACTIVE, "alice2"),
+            ("alice", Priority.BACKGROUND, "summary"),
+            ("bob", Priority.INTERACTIVE, "bob0"),
+        ]:
+            calls.append(asyncio.create_task(self.call(scheduler, session, priority, name, order)))
+        await asyncio.gather(*calls)
+
+        self.assertEqual(order, ["alice0", "alice1", "bob0", "alice2", "summary"])
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_overloaded(self):
+        scheduler, order = Scheduler(limit=1, max_queued=2), []
+        calls = [asyncio.create_task(self.call(scheduler, "alice", Priority.INTERACTIVE, "alice0", order))]
+        await asyncio.sleep(0)
+        calls.append(asyncio.create_task(self.call(scheduler, "bob", Priority.INTERACTIVE, "bob0", order)))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Overloaded):  # Background calls are shed first
+            await self.call(scheduler, "alice", Priority.BACKGROUND, "summary", order)
+        calls.append(asyncio.create_task(self.call(scheduler, "carol", Priority.INTERACTIVE, "carol0", order)))
+        await asyncio.sleep(0)
+        with self.assertRaises(Overloaded):
+            await self.call(scheduler, "dave", Priority.INTERACTIVE, "dave0", order)
+        await asyncio.gather(*calls)
+        self.assertEqual(order, ["alice0", "bob0", "carol0"])
+
+    async def test_cancelled_while_waiting(self):
+        scheduler, order = Scheduler(limit=1), []
+        first = asyncio.create_task(self.call(scheduler, "alice", Priority.INTERACTIVE, "alice0", order))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(self.call(scheduler, "bob", Priority.INTERACTIVE, "bob0", order))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await first
+
+        self.assertEqual(order, ["alice0"])
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_cancelled_as_released(self):
+        scheduler, order, release = Scheduler(limit=1), [], asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot("alice", Priority.INTERACTIVE):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        bob = asyncio.create_task(self.call(scheduler, "bob", Priority.INTERACTIVE, "bob0", order))
+        carol = asyncio.create_task(self.call(scheduler, "carol", Priority.INTERACTIVE, "carol0", order))
+        await asyncio.sleep(0)
+        release.set()  # The slot is released in the same loop iteration as bob gives up
+        bob.cancel()
+        await holder
+        await carol
+
+        self.assertTrue(bob.cancelled())
+        self.assertEqual(order, ["carol0"])
+        self.assertEqual(scheduler.running, 0)
+        self.assertEqual(scheduler._queued, 0)
+
+    async def test_promoted(self):
+        scheduler, order = Scheduler(limit=1), []
+        calls = [asyncio.create_task(self.call(scheduler, "alice", Priority.INTERACTIVE, "alice0", order))]
+        await asyncio.sleep(0)
+        speculation = asyncio.create_task(self.call(scheduler, "bob", Priority.BACKGROUND, "speculation", order))
+        await asyncio.sleep(0)
+        for name in ["carol0", "carol1"]:
+            calls.append(asyncio.create_task(self.call(scheduler, "carol", Priority.INTERACTIVE, name, order)))
+        await asyncio.sleep(0)
+        scheduler.promote(speculation)  # Bob picked that option and now waits on it
+        await asyncio.gather(speculation, *calls)
+
+        self.assertEqual(order, ["alice0", "carol0", "speculation", "carol1"])
+        self.assertEqual(scheduler._queued, 0)
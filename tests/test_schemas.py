@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+import schemas
+from narrator import GameNarrator
+
+
+class TestSchemas(TestCase):
+    TURN = {
+        "short_version": "She opens the door",
+        "long_version": "She pushes the heavy door, which opens on a dark corridor.",
+        "location": "In the corridor",
+        "objective": "Finding the stairs",
+        "options": ["She runs", "She hides", "She sings"],
+    }
+
+    def test_valid_turn(self):
+        schemas.validate(self.TURN, schemas.TURN)
+
+    def test_missing_key(self):
+        turn = {k: v for k, v in self.TURN.items() if k != "objective"}
+        with self.assertRaises(AssertionError):
+            schemas.validate(turn, schemas.TURN)
+
+    def test_wrong_options(self):
+        with self.assertRaises(AssertionError):
+            schemas.validate({**self.TURN, "options": ["She runs", "She hides"]}, schemas.TURN)
+        with self.assertRaises(AssertionError):
+            schemas.validate({**self.TURN, "options": ["She runs", "She hides", 3]}, schemas.TURN)
+
+    def test_parse_options(self):
+        self.assertEqual(GameNarrator.parse_options('{"options": ["Run", "Hide", "Sing"]}'), ["Run", "Hide", "Sing"])
+        self.assertEqual(GameNarrator.parse_options('["Run", "Hide", "Sing"]'), ["Run", "Hide", "Sing"])
+        with self.assertRaises(AssertionError):
+            GameNarrator.parse_options('{"choices": "Run, Hide or Sing"}')
+        with self.assertRaises(AssertionError):
+            GameNarrator.parse_options('{"options": ["Run", "Hide"]}')
+
+    def test_parse_nested_descriptions(self):
+        descriptions = GameNarrator.parse_descriptions('{"result": {"short_version": "Run", "long_version": "Run!"}}')
+        self.assertEqual(descriptions["short_version"], "Run")
@@ -0,0 +1,65 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from narrator import GameNarrator
+from speculation import Speculator
+from state import GameState, SessionStore
+
+OPTIONS = ["Open the door", "Climb the tower", "Call the dragon"]
+
+
+class StubNarrator(GameNarrator):
+    """Answers every action after a while, without asking any model."""
+
+    def __init__(self):
+        super().__init__()
+        self.asked = []
+
+    async def aask(self, task, prompt, parse, retries, tried=0):
+        action = next(option for option in OPTIONS if option in prompt)
+        self.asked.append(action)
+        await asyncio.sleep(0.01)
+        return {"short_version": action, "long_version": f"She did: {action}"}, action
+
+
+class TestSpeculator(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.narrator = StubNarrator()
+        self.speculator = Speculator(self.narrator)
+        self.game_state = GameState("Intro")
+
+    async def test_hit(self):
+        self.speculator.start(self.game_state, OPTIONS)
+        roll, outcome = self.speculator.claim(self.game_state, "Climb the tower")
+        descriptions, source, result_score = await outcome
+
+        self.assertEqual(descriptions["long_version"], "She did: Climb the tower")
+        self.assertEqual(result_score, roll)
+
+    async def test_miss_after_history_changed(self):
+        self.speculator.start(self.game_state, OPTIONS)
+        self.game_state.update(["She took another path"])
+
+        self.assertIsNone(self.speculator.claim(self.game_state, "Climb the tower"))
+
+    async def test_losers_cancelled(self):
+        self.speculator.start(self.game_state, OPTIONS)
+        (_, pending) = self.speculator._pending[self.game_state]
+        losers = [outcome for option, (_, outcome) in pending.items() if option != "Open the door"]
+        _, outcome = self.speculator.claim(self.game_state, "Open the door")
+        await outcome
+        await asyncio.sleep(0)
+
+        self.assertFalse(outcome.cancelled())
+        self.assertTrue(all(loser.cancelled() for loser in losers))
+
+    async def test_cancelled_on_eviction(self):
+        sessions = SessionStore(lambda: GameState("Intro"), max_sessions=1, on_evict=self.speculator.cancel)
+        alice = sessions.get("alice")
+        self.speculator.start(alice, OPTIONS)
+        (_, pending) = self.speculator._pending[alice]
+        sessions.get("bob")
+        await asyncio.sleep(0)
+
+        self.assertTrue(all(outcome.cancelled() for _, outcome in pending.values()))
+        self.assertNotIn(alice, self.speculator._pending)
@@ -1,7 +1,8 @@
+import time
 from unittest import TestCase
 
 from narrator import GameNarrator
-from state import GameState
+from state import GameState, SessionStore
 
 
 class TestIntro(TestCase):
@@ -23,3 +24,86 @@ class TestIntro(TestCase):
         self.assertIn("outer space", history)
         self.assertNotIn("Moon", history)
         self.assertNotIn("Low-Earth Orbit", history)
+
+    def test_separate_histories(self):
+        game_state = GameState(TestIntro.INTRO)
+        other_state = GameState(TestIntro.INTRO)
+        game_state.update(["She is now in outer space floating above the Earth"])
+
+        self.assertNotIn("outer space", other_state.history_so_far())
+
+
+class TestSessionStore(TestCase):
+    def test_same_session(self):
+        sessions = SessionStore(lambda: GameState(TestIntro.INTRO))
+        sessions.get("alice").update(["She found a key"])
+
+        self.assertIn("She found a key", sessions.get("alice").history_so_far())
+        self.assertNotIn("She found a key", sessions.get("bob").history_so_far())
+
+    def test_max_sessions(self):
+        sessions = SessionStore(lambda: GameState(TestIntro.INTRO), max_sessions=2)
+        sessions.get("alice")
+        sessions.get("bob")
+        sessions.get("alice")
+        sessions.get("carol")
+
+        self.assertEqual(len(sessions), 2)
+        self.assertIn("alice", sessions)
+        self.assertNotIn("bob", sessions)
+
+    def test_max_chars(self):
+        sessions = SessionStore(lambda: GameState("Intro"), max_chars=100)
+        sessions.get("alice").update(["x" * 80])
+        sessions.get("bob").update(["y" * 80])
+        sessions.get("carol")
+
+        self.assertNotIn("alice", sessions)
+        self.assertIn("bob", sessions)
+
+    def test_idle_timeout(self):
+        sessions = SessionStore(lambda: GameState(TestIntro.INTRO), idle_timeout=0)
+        sessions.get("alice")
+        time.sleep(0.01)
+        sessions.get("bob")
+
+        self.assertNotIn("alice", sessions)
+        self.assertIn("bob", sessions)
+
+    def test_on_evict(self):
+        evicted = []
+        sessions = SessionStore(lambda: GameState(TestIntro.INTRO), max_sessions=1, on_evict=evicted.append)
+        alice = sessions.get("alice")
+        sessions.get("bob")
+
+        self.assertEqual(evicted, [alice])
+
+
+class TestRollingHistory(TestCase):
+    def test_fold(self):
+        game_state = GameState("Intro", recent_beats=2)
+        game_state.update(["First", "Second", "Third", "Fourth"])
+        since, until, beats = game_state.to_fold()
+        self.assertEqual(beats, ["First", "Second"])
+
+        self.assertTrue(game_state.fold("She did two things", since, until))
+        history = game_state.history_so_far()
+        self.assertIn("She did two things", history)
+        self.assertNotIn("First", history)
+        self.assertIn("Fourth", history)
+        self.assertIsNone(game_state.to_fold())
+
+    def test_token_budget(self):
+        game_state = GameState("Intro", recent_beats=8, max_history_tokens=30)
+        game_state.update(["a" * 60, "b" * 60, "c" * 60, "d" * 60])
+        _, _, beats = game_state.to_fold()
+        self.assertEqual(beats, ["a" * 60, "b" * 60])
+
+    def test_stale_fold(self):
+        game_state = GameState("Intro", recent_beats=2)
+        game_state.update(["First", "Second", "Third", "Fourth"])
+        since, until, _ = game_state.to_fold()
+        game_state.fold("Summary", since, until)
+
+        self.assertFalse(game_state.fold("Outdated summary", since, until))
+        self.assertIn("Summary", game_state.history_so_far())
@@ -0,0 +1,170 @@
+"""Persistent, content-addressed caches for oracle responses and illustrations."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from PIL import Image
+
+
+class ResponseCache:
+    """Stores replies in SQLite under a hash of their full request, evicting least recently used ones past a size."""
+
+    def __init__(self, path: str = "generated/responses.sqlite", max_bytes: int = 64 * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, content TEXT, source TEXT, size INTEGER, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_used)")
+        self._db.commit()
+        (self._bytes,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+    # What determines a reply: transport settings such as `keep_alive` are left out, changing them keeps the cache
+    KEY_FIELDS = ("model", "messages", "format", "options")
+
+    @staticmethod
+    def key(request: dict[str, Any]) -> str:
+        """Content address of a request: its model, messages (system prompt & prompt), format and options."""
+        fields = {name: request.get(name) for name in ResponseCache.KEY_FIELDS}
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, request: dict[str, Any]) -> Optional[tuple[str, str]]:
+        """The cached (content, source) reply to this request, if any."""
+        key = self.key(request)
+        with self._lock:
+            row = self._db.execute("SELECT content, source FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0], row[1]
+
+    def put(self, request: dict[str, Any], content: str, source: str) -> None:
+        key = self.key(request)
+        size = len(content.encode()) + len(source.encode())
+        with self._lock:
+            replaced = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, content, source, size, time.time()),
+            )
+            self._bytes += size - (replaced[0] if replaced else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        """Drops least recently used replies until the cache fits in `max_bytes`, tracked as a running total."""
+        if self._bytes <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._bytes -= size
+            if self._bytes <= self.max_bytes:
+                break
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __str__(self):
+        return f"ResponseCache: {self.hits} hits / {self.misses} misses ({self.hit_rate:.0%} hit rate), {len(self)} replies"
+
+
+class ImageCache:
+    """Stores images as PNG files named by a hash of what produced them, evicting least recently used ones past a size.
+
+    Several processes may share a directory: each tracks the files it knows of, and serves those written by others.
+    """
+
+    def __init__(self, directory: str = "generated/images/cache", max_bytes: int = 512 * 1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        files = [entry for entry in os.scandir(directory) if entry.name.endswith(".png")]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        self._sizes: OrderedDict[str, int] = OrderedDict(  # Least recently used first
+            (entry.name[: -len(".png")], entry.stat().st_size) for entry in files
+        )
+
+    @staticmethod
+    def key(params: dict[str, Any]) -> str:
+        """Content address of an image: everything that determines it, e.g. its prompt, model, steps and seed."""
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, params: dict[str, Any]) -> Optional[Image.Image]:
+        """The cached image for these parameters, if any."""
+        key = self.key(params)
+        try:
+            with Image.open(self.path(key)) as file:
+                image = file.copy()
+            os.utime(self.path(key))
+        except (FileNotFoundError, OSError):
+            with self._lock:
+                self.misses += 1
+                self._sizes.pop(key, None)
+            return None
+        with self._lock:
+            self.hits += 1
+            if key not in self._sizes:
+                self._sizes[key] = os.path.getsize(self.path(key))
+            self._sizes.move_to_end(key)
+        return image
+
+    def put(self, params: dict[str, Any], image: Image.Image) -> None:
+        key = self.key(params)
+        partial = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(partial, format="PNG")
+        os.replace(partial, self.path(key))  # Readers see either no file or a complete one
+        with self._lock:
+            self._sizes[key] = os.path.getsize(self.path(key))
+            self._sizes.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        """Drops least recently used images until the cache fits in `max_bytes`."""
+        total = sum(self._sizes.values())
+        while total > self.max_bytes and len(self._sizes) > 1:
+            key, size = self._sizes.popitem(last=False)
+            total -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass  # Evicted by another process
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sizes)
+
+    def __str__(self):
+        return f"ImageCache: {self.hits} hits / {self.misses} misses ({self.hit_rate:.0%} hit rate), {len(self)} images"
@@ -0,0 +1,34 @@
+"""Process-wide counters and gauges, to see where turns spend their time and retries."""
+
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """Named counters (incremented) and gauges (set), safe to update from any thread."""
+
+    def __init__(self):
+        self._values: dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[name] += amount
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+    def __str__(self):
+        return "Metrics: " + ", ".join(f"{name}={value:g}" for name, value in self.snapshot().items())
+
+
+metrics = Metrics()
@@ -0,0 +1,179 @@
+"""Incremental reading of JSON replies while they are still being generated, and repair of near-misses."""
+
+import json
+import re
+from json import JSONDecodeError
+from typing import Any, Iterator, Optional
+
+from utils.metrics import metrics
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class StreamedString:
+    """Follows a JSON object chunk by chunk, decoding the string under a top-level `key` as soon as it starts.
+
+    Each character is looked at once, so feeding a whole reply costs O(reply) however it is chunked.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.done = False
+        self._value: list[str] = []
+        self._depth = 0
+        self._expect_key = False
+        self._in_string = False
+        self._is_key = False
+        self._capturing = False
+        self._escape = ""
+        self._high_surrogate: Optional[int] = None
+        self._token: list[str] = []
+        self._last_key = None
+
+    @property
+    def value(self) -> str:
+        """The value decoded so far, complete once `done`."""
+        return "".join(self._value)
+
+    def feed(self, chunk: str) -> str:
+        """Consumes the next chunk of the reply and returns the value decoded so far."""
+        for char in chunk:
+            if self._in_string:
+                self._string_char(char)
+            elif char == '"':
+                self._in_string = True
+                self._is_key = self._depth == 1 and self._expect_key
+                self._capturing = not self._is_key and not self.done and self._depth == 1 and self._last_key == self.key
+                self._token = []
+            elif char in "{[":
+                self._depth += 1
+                self._expect_key = self._depth == 1 and char == "{"
+            elif char in "}]":
+                self._depth -= 1
+            elif self._depth == 1 and char in ":,":
+                self._expect_key = char == ","
+        return self.value
+
+    def _string_char(self, char: str) -> None:
+        if self._escape:
+            self._escape += char
+            if self._escape[1] == "u":
+                if len(self._escape) < 6:
+                    return
+                escape, self._escape = self._escape, ""
+                try:
+                    code = int(escape[2:], 16)
+                except ValueError:
+                    self._append(escape)
+                    return
+                if 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+                    # The second half of an escaped astral character, e.g. an emoji: combine them like `json` does
+                    code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+                    self._high_surrogate = None
+                elif 0xD800 <= code <= 0xDBFF:
+                    self._flush_surrogate()
+                    self._high_surrogate = code
+                    return
+                self._append(chr(code))
+                return
+            self._escape = ""
+            self._append(_ESCAPES.get(char, char))
+        elif char == "\\":
+            self._escape = char
+        elif char == '"':
+            self._flush_surrogate()
+            self._in_string = False
+            if self._is_key:
+                self._last_key = "".join(self._token)
+            elif self._capturing:
+                self._capturing = False
+                self.done = True
+        else:
+            self._append(char)
+
+    def _flush_surrogate(self) -> None:
+        if self._high_surrogate is not None:  # Unpaired, kept as is like `json` does
+            high, self._high_surrogate = self._high_surrogate, None
+            self._append(chr(high))
+
+    def _append(self, decoded: str) -> None:
+        self._flush_surrogate()
+        if self._is_key:
+            self._token.append(decoded)
+        elif self._capturing:
+            self._value.append(decoded)
+
+
+_DANGLING_KEY = re.compile(r'[{,]\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+
+
+def repair_json(text: str) -> Any:
+    """
+    Parses a reply that should be JSON, recovering the usual near-misses without asking the model again:
+    a stray prefix or suffix (e.g. "Here you go:", code fences), trailing commas,
+    mismatched closing brackets, and replies truncated before their end.
+    :raises JSONDecodeError: if the reply can't be recovered.
+    """
+    try:
+        return json.loads(text)
+    except JSONDecodeError as error:
+        failure = error
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise failure
+    body, closers = _balance(text[min(starts) :])
+    for candidate in _truncations(body):
+        try:
+            value = json.loads(candidate + closers)
+        except JSONDecodeError:
+            continue
+        metrics.increment("json.repaired")
+        return value
+    raise failure
+
+
+def _balance(text: str) -> tuple[str, str]:
+    """Reads the first JSON value in text, dropping what follows it and trailing commas within it.
+    :return: a tuple: the value as read, the closing brackets it misses if it was truncated."""
+    out, stack = [], []
+    in_string, escape = False, False
+    for char in text:
+        if in_string:
+            out.append(char)
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            out.append(char)
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            out.append(char)
+        elif char in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            out.append(stack.pop())
+            if not stack:
+                break
+        else:
+            out.append(char)
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+    return "".join(out), "".join(reversed(stack))
+
+
+def _truncations(body: str) -> Iterator[str]:
+    """Ways to end a truncated value: as is, or without its dangling comma, colon or key."""
+    yield body
+    body = body.rstrip().rstrip(",:").rstrip()
+    yield body
+    dangling = _DANGLING_KEY.search(body)
+    if dangling:
+        yield body[: dangling.start() + 1].rstrip(",")
@@ -0,0 +1,128 @@
+"""An append-only log of generations, written by a background thread rather than on the request path."""
+
+import atexit
+import datetime
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from typing import IO, Any, Optional
+
+from PIL.Image import Image
+
+from utils.metrics import metrics
+
+
+class GenerationLog:
+    """Appends records to JSONL segments and saves images, from a background thread.
+
+    Segments are named by their start time and process, rotate past `max_bytes` and are gzipped if `compress`.
+    Pending writes are flushed at exit; past `max_queued` of them, new ones are dropped rather than blocking players.
+    """
+
+    def __init__(
+        self,
+        directory: str = "generated/log",
+        max_bytes: int = 16 * 1024 * 1024,
+        compress: bool = False,
+        max_queued: int = 1000,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._queue: queue.Queue = queue.Queue(max_queued)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._segment: Optional[IO[str]] = None
+        self._segment_bytes = 0
+        self.segments = 0
+
+    def append(self, record: dict[str, Any]) -> None:
+        """Logs a record, along with the time it was made."""
+        self._put(("record", {"time": datetime.datetime.now().isoformat(), **record}))
+
+    def save_image(self, image: Image, path: str) -> None:
+        """Saves an image as PNG, creating its directory if needed."""
+        self._put(("image", image, path))
+
+    def _put(self, item: tuple) -> None:
+        self._start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            metrics.increment("log.dropped")
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="generation-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def flush(self) -> None:
+        """Waits for pending writes."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """Flushes pending writes and closes the current segment."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+            atexit.unregister(self.close)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self._close_segment()
+                    return
+                if item[0] == "record":
+                    self._write(item[1])
+                else:
+                    self._write_image(*item[1:])
+                if self._queue.empty() and self._segment is not None:
+                    self._segment.flush()  # Batch writes while busy, but don't leave them in buffers once idle
+            except Exception as e:
+                print(f"Error writing generation log: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, default=str) + "\n"
+        if self._segment is None or self._segment_bytes + len(line) > self.max_bytes:
+            self._rotate()
+        self._segment.write(line)
+        self._segment_bytes += len(line)
+        metrics.increment("log.records")
+
+    def _write_image(self, image: Image, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        image.save(path)
+        metrics.increment("log.images")
+
+    def _rotate(self) -> None:
+        self._close_segment()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{int(time.time() * 1000)}-{os.getpid()}-{self.segments}.jsonl"
+        if self.compress:
+            self._segment = gzip.open(os.path.join(self.directory, f"{name}.gz"), "at", encoding="utf-8")
+        else:
+            self._segment = open(os.path.join(self.directory, name), "a", encoding="utf-8")
+        self._segment_bytes = 0
+        self.segments += 1
+
+    def _close_segment(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+
+generation_log = GenerationLog()
@@ -0,0 +1,90 @@
+"""Batched illustrations: requests arriving together are rendered in one pipeline call, for more images per device."""
+
+import asyncio
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Optional
+
+from PIL.Image import Image
+
+from utils.metrics import metrics
+from visuals.jobs import Superseded
+
+RenderBatch = Callable[[list[dict[str, Any]], Callable[[], bool]], Awaitable[list[Optional[Image]]]]
+
+
+class Batcher:
+    """Collects illustration requests for `window` seconds, then renders those sharing a model and steps together.
+
+    A batch stops early only once every request in it is stale, and its images are fanned out to each caller.
+    """
+
+    def __init__(self, render_batch: RenderBatch, window: float = 0.05, max_batch: int = 4):
+        """
+        :param render_batch: renders a list of `image_params` with a `stop()` function, e.g. `text2image_batch`
+        :param max_batch: requests rendered at once at most, as memory grows with batch size
+        """
+        self.render_batch = render_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: dict[tuple, list[tuple[dict[str, Any], Optional[Callable[[], bool]], asyncio.Future]]] = (
+            defaultdict(list)
+        )
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()  # Strong references, so batches aren't garbage-collected
+
+    @staticmethod
+    def group(params: dict[str, Any]) -> tuple:
+        """Requests can share a pipeline call if they share a model, its sampling settings and steps."""
+        return params["preset"], params["model"], params["steps"]
+
+    async def render(self, params: dict[str, Any], stop: Optional[Callable[[], bool]] = None) -> Optional[Image]:
+        """
+        Renders these `image_params` along with other requests arriving meanwhile.
+        :param stop: tells if this request became stale, which then raises Superseded
+        """
+        group = self.group(params)
+        outcome = asyncio.get_running_loop().create_future()
+        pending = self._pending[group]
+        pending.append((params, stop, outcome))
+        if len(pending) == 1:
+            self._timers[group] = asyncio.get_running_loop().call_later(self.window, self._flush, group)
+        if len(pending) >= self.max_batch:
+            self._flush(group)
+        return await outcome
+
+    def _flush(self, group: tuple) -> None:
+        self._timers.pop(group).cancel()
+        requests = self._pending.pop(group)
+        live = []
+        for params, stop, outcome in requests:
+            if outcome.done():  # Its caller was cancelled
+                continue
+            if stop is not None and stop():
+                outcome.set_exception(Superseded("Superseded before rendering"))
+            else:
+                live.append((params, stop, outcome))
+        if live:
+            metrics.increment("images.batches")
+            metrics.increment("images.batched", len(live))
+            task = asyncio.create_task(self._render(live))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _render(self, requests: list[tuple[dict[str, Any], Optional[Callable[[], bool]], asyncio.Future]]):
+        def all_stale() -> bool:
+            return all(stop is not None and stop() for _, stop, _ in requests)
+
+        try:
+            images = await self.render_batch([params for params, _, _ in requests], all_stale)
+        except Exception as e:
+            for _, _, outcome in requests:
+                if not outcome.done():
+                    outcome.set_exception(e)
+            return
+        for (_, stop, outcome), image in zip(requests, images):
+            if outcome.done():
+                continue
+            if stop is not None and stop():
+                outcome.set_exception(Superseded("Superseded while rendering"))
+            else:
+                outcome.set_result(image)
@@ -1,8 +1,12 @@
 import datetime
-import os.path
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 from functools import lru_cache
-from typing import Optional
+from typing import Any, Callable, Optional
 
+import PIL.Image
 import torch
 from PIL.Image import Image
 from diffusers import AutoencoderKL, UNet2DConditionModel, DiffusionPipeline
@@ -11,6 +15,10 @@ from numpy.random import randint
 from transformers import CLIPTextModel, CLIPTokenizer
 
 from prompts import IMAGE_STYLES
+from utils.cache import ImageCache
+from utils.metrics import metrics
+from utils.save import generation_log
+from visuals.jobs import Superseded
 
 
 def wrap_story(story: str, style: str = "") -> str:
@@ -114,39 +122,214 @@ def text2image_manual(prompt: str) -> Image:
     return image
 
 
-def text2image_v2(prompt: str, num_inference_steps: int = 150, height=512, width=512) -> Image:
-    print(f"Running T2I v2: {prompt}")
-    generator, pipe = init_v2(num_inference_steps)
+IMAGE_CACHE = True  # Serve repeated illustrations from disk, see ImageCache
 
-    image = pipe(
-        prompt,
-        guidance_scale=7.5,
-        height=height,
-        width=width,
-        negative_prompt="text, hands",
-        num_inference_steps=num_inference_steps,
-        generator=generator,
-    ).images[0]
 
-    return image
+@dataclass(frozen=True)
+class Preset:
+    """A model and how to sample it: few-step models trade some quality for an illustration in seconds on CPU."""
+
+    model_id: str
+    steps: int  # Inference steps for a full illustration
+    fast_steps: int  # Inference steps when fast=True
+    guidance_scale: float
+    dpm_solver: bool = False  # Replace the model's default scheduler by DPM-Solver++
+
+
+PRESETS: dict[str, Preset] = {
+    # Our V2 StableDiffusion back-end
+    "quality": Preset(
+        "stabilityai/stable-diffusion-2-1", steps=150, fast_steps=50, guidance_scale=7.5, dpm_solver=True
+    ),
+    # Distilled from SD 2.1, sampled in 1 to 4 steps without classifier-free guidance
+    "turbo": Preset("stabilityai/sd-turbo", steps=4, fast_steps=1, guidance_scale=0.0),
+}
+
+NEGATIVE_PROMPT = "text, hands"
+MAX_EMBEDDINGS = 256  # Prompt embeddings kept, about 150KB each for SD 2.x in half precision
+
+# Prompt embeddings by model, device and prompt, least recently used first
+_embeddings: OrderedDict[tuple[str, str, str], torch.Tensor] = OrderedDict()
+_embeddings_lock = threading.Lock()
+
+# Pipelines loaded so far, with a lock as a pipeline runs one generation at a time
+_pipelines: dict[tuple[str, str], tuple[StableDiffusionPipeline, threading.Lock]] = {}
+_pipelines_lock = threading.Lock()
 
 
 @lru_cache(maxsize=1)
-def init_v2(num_inference_steps) -> tuple[torch.Generator, StableDiffusionPipeline]:
+def default_device() -> str:
+    """The best available device: CUDA, else Apple Silicon, else CPU."""
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def default_preset() -> str:
+    """Full-quality illustrations on GPU, few-step ones elsewhere."""
+    return "quality" if default_device() == "cuda" else "turbo"
+
+
+def text2image_v2(
+    prompt: str,
+    num_inference_steps: Optional[int] = None,
+    height=512,
+    width=512,
+    seed: Optional[int] = None,
+    preset: Optional[str] = None,
+    stop: Optional[Callable[[], bool]] = None,
+) -> Image:
+    print(f"Running T2I v2: {prompt}")
+    settings = PRESETS[preset or default_preset()]
+    seed = randint(0, 64000) if seed is None else seed  # Diverse results at each run by default
+    return generate(settings, [prompt], [seed], num_inference_steps or settings.steps, height, width, stop)[0]
+
+
+def text2image_batch(
+    batch: list[dict[str, Any]],
+    stop: Optional[Callable[[], bool]] = None,
+    preview: Optional[Callable[[list[Image]], None]] = None,
+) -> list[Optional[Image]]:
     """
-    Initialize and cache the Generator and Pipeline used for our V2 StableDiffusion back-end.
+    Renders several `image_params` in one pipeline call, caching each illustration.
+    They must share their preset and steps, e.g. requested meanwhile by several players or in several styles.
+    :param stop: polled at each step, raising Superseded once it returns True
+    :param preview: called every few steps with approximate images, before the full decoding at the end
+    :return: an illustration per params, all None if the batch failed
     """
-    print("Initializing Text2ImageV2 components.")
-    model_id = "stabilityai/stable-diffusion-2-1"
-    # Use the DPMSolverMultistepScheduler (DPM-Solver++) scheduler here instead
-    pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16)
-    scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
-    scheduler.set_timesteps(num_inference_steps)
-    generator = torch.Generator(device="cuda")
-    generator.manual_seed(randint(0, 64000))  # Diverse results at each run
-    pipe.scheduler = scheduler
-    pipe = pipe.to("cuda")
-    return generator, pipe
+    try:
+        print(f"Running T2I batch of {len(batch)}: {[params['prompt'] for params in batch]}")
+        settings = PRESETS[batch[0]["preset"]]
+        prompts, seeds = [params["prompt"] for params in batch], [params["seed"] for params in batch]
+        images = generate(settings, prompts, seeds, batch[0]["steps"], stop=stop, preview=preview)
+        for params, image in zip(batch, images):
+            if IMAGE_CACHE:
+                image_cache().put(params, image)
+            generation_log.append({"illustration": params})
+        return images
+    except Superseded:
+        raise
+    except Exception as e:
+        print(f"Error generating images: {e}")
+        return [None] * len(batch)
+
+
+def generate(
+    settings: Preset,
+    prompts: list[str],
+    seeds: list[int],
+    steps: int,
+    height=512,
+    width=512,
+    stop: Optional[Callable[[], bool]] = None,
+    preview: Optional[Callable[[list[Image]], None]] = None,
+    preview_every: int = 5,
+) -> list[Image]:
+    """One pipeline call, rendering each prompt with its own seed."""
+    device = default_device()
+    pipe, lock = get_pipeline(settings, device)
+    generator_device = "cpu" if device == "mps" else device  # MPS generators aren't supported
+    generators = [torch.Generator(device=generator_device).manual_seed(seed) for seed in seeds]
+    guided = settings.guidance_scale > 1  # Otherwise the pipeline skips classifier-free guidance
+
+    with lock:
+        prompt_embeds = torch.cat([embed(pipe, settings, device, prompt) for prompt in prompts])
+        negative_embeds = embed(pipe, settings, device, NEGATIVE_PROMPT).expand_as(prompt_embeds) if guided else None
+        return pipe(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_embeds,
+            guidance_scale=settings.guidance_scale,
+            height=height,
+            width=width,
+            num_inference_steps=steps,
+            generator=generators,
+            callback_on_step_end=on_step_end(stop, preview, preview_every),
+            callback_on_step_end_tensor_inputs=["latents"],
+        ).images
+
+
+@torch.no_grad()
+def embed(pipe: StableDiffusionPipeline, settings: Preset, device: str, prompt: str) -> torch.Tensor:
+    """
+    The text encoder's embeddings of a prompt, cached as the negative prompt and recurring captions repeat.
+    Style prefixes aren't reused within different prompts: transformers' CLIP text encoder can't resume from a prefix.
+    """
+    key = (settings.model_id, device, prompt)
+    with _embeddings_lock:
+        if key in _embeddings:
+            _embeddings.move_to_end(key)
+            metrics.increment("images.embeddings_hit")
+            return _embeddings[key]
+    metrics.increment("images.embeddings_miss")
+    embeddings, _ = pipe.encode_prompt(prompt, device, num_images_per_prompt=1, do_classifier_free_guidance=False)
+    with _embeddings_lock:
+        _embeddings[key] = embeddings
+        while len(_embeddings) > MAX_EMBEDDINGS:
+            _embeddings.popitem(last=False)
+    return embeddings
+
+
+def on_step_end(
+    stop: Optional[Callable[[], bool]], preview: Optional[Callable[[list[Image]], None]], preview_every: int
+) -> Callable[..., dict]:
+    """
+    A step callback interrupting the pipeline with Superseded as soon as `stop()` tells its result isn't needed,
+    and showing approximate images of its latents every `preview_every` steps.
+    """
+
+    def callback(pipe, step: int, timestep: int, callback_kwargs: dict) -> dict:
+        if stop is not None and stop():
+            raise Superseded(f"Stopped at step {step}")
+        if preview is not None and (step + 1) % preview_every == 0 and step + 1 < pipe.num_timesteps:
+            preview([latents_to_rgb(latents) for latents in callback_kwargs["latents"]])
+        return callback_kwargs
+
+    return callback
+
+
+# How much each of the 4 latent channels of the Stable Diffusion VAE contributes to R, G and B, fitted on decoded images
+# See https://discuss.huggingface.co/t/decoding-latents-to-rgb-without-upscaling/23204
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+def latents_to_rgb(latents: torch.Tensor) -> Image:
+    """A cheap approximation of the VAE decoder, good enough to preview a generation: a linear map of each latent."""
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32)
+    rgb = torch.einsum("chw,cr->hwr", latents.detach().float().cpu(), factors)
+    pixels = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).numpy()
+    preview = PIL.Image.fromarray(pixels)
+    return preview.resize((preview.width * 8, preview.height * 8))  # Latents are 8 times smaller than images
+
+
+def get_pipeline(settings: Preset, device: str) -> tuple[StableDiffusionPipeline, threading.Lock]:
+    """
+    Load once and cache the Pipeline for a model on a device, along with the lock to hold while using it.
+    Steps and seeds are chosen per call, so changing them never reloads the model.
+    """
+    key = (settings.model_id, device)
+    with _pipelines_lock:
+        if key not in _pipelines:
+            print(f"Initializing Text2Image pipeline {settings.model_id} on {device}.")
+            dtype = torch.float16 if device == "cuda" else torch.float32  # Half precision is slow or unsupported on CPU
+            pipe = StableDiffusionPipeline.from_pretrained(settings.model_id, torch_dtype=dtype)
+            if settings.dpm_solver:
+                # Use the DPMSolverMultistepScheduler (DPM-Solver++) scheduler here instead
+                pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+            pipe.enable_attention_slicing()  # Lower peak memory, for smaller GPUs and RAM-bound hosts
+            _pipelines[key] = pipe.to(device), threading.Lock()
+        return _pipelines[key]
+
+
+def warmup(preset: Optional[str] = None) -> None:
+    """Loads the pipeline of this preset ahead of the first illustration."""
+    get_pipeline(PRESETS[preset or default_preset()], default_device())
 
 
 def text2image_hyper(prompt: str, num_inference_steps: int = 1) -> Image:
@@ -216,11 +399,58 @@ def load_lora_pipe():
     return pipe
 
 
-def text2image(story: str, style: str = "", fast=False, save: bool = True) -> Optional[Image]:
-    """Use our current best text2image model, with wrapping of story."""
+def image_params(story: str, style: str, fast: bool, seed: Optional[int], preset: Optional[str]) -> dict[str, Any]:
+    """Everything that determines an illustration, which is what we cache it by."""
+    prompt = wrap_story(story, style)
+    preset = preset or default_preset()
+    settings = PRESETS[preset]
+    if seed is None:
+        seed = int.from_bytes(hashlib.sha256(prompt.encode()).digest()[:4], "big")
+    return {
+        "prompt": prompt,
+        "style": style,
+        "preset": preset,
+        "model": settings.model_id,
+        "steps": settings.fast_steps if fast else settings.steps,
+        "seed": seed,
+    }
+
+
+@lru_cache(maxsize=1)
+def image_cache() -> ImageCache:
+    return ImageCache()
+
+
+def cached(params: dict[str, Any]) -> Optional[Image]:
+    """The cached illustration for these `image_params`, if any."""
+    return image_cache().get(params) if IMAGE_CACHE else None
+
+
+def text2image(
+    story: str,
+    style: str = "",
+    fast=False,
+    save: bool = True,
+    seed: Optional[int] = None,
+    preset: Optional[str] = None,
+    stop: Optional[Callable[[], bool]] = None,
+) -> Optional[Image]:
+    """
+    Use our current best text2image model, with wrapping of story.
+    Illustrations are cached: by default the seed derives from the prompt, so the same story is illustrated the same.
+    :param preset: a key of PRESETS, by default "quality" on CUDA and the few-step "turbo" elsewhere
+    :param stop: polled at each step, raising Superseded once it returns True
+    """
     try:
-        prompt = wrap_story(story, style)
-        image: Image = text2image_v2(prompt, 50 if fast else 150)
+        params = image_params(story, style, fast, seed, preset)
+        image = cached(params)
+        if image is not None:
+            return image
+        image: Image = text2image_v2(
+            params["prompt"], params["steps"], seed=params["seed"], preset=params["preset"], stop=stop
+        )
+        if IMAGE_CACHE:
+            image_cache().put(params, image)
         if save:
             key = (
                 f"{story[:80]}".strip()
@@ -237,10 +467,10 @@ def text2image(story: str, style: str = "", fast=False, save: bool = True) -> Op
                 .replace("/", "")
             )
             time = int(datetime.datetime.now().timestamp())
-            if not os.path.exists("./generated/images/"):
-                os.mkdir("./generated/images/")
-            image.save(f"./generated/images/{key}_{time}.png")
+            generation_log.save_image(image, f"./generated/images/{key}_{time}.png")
         return image
+    except Superseded:
+        raise
     except Exception as e:
         print(f"Error generating image: {e}")
         return None  # No big deal
@@ -0,0 +1,61 @@
+"""Latest-wins illustration jobs: of a burst of requests for the same session, only the last one is rendered."""
+
+import asyncio
+import itertools
+import threading
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from utils.metrics import metrics
+
+T = TypeVar("T")
+
+
+class Superseded(Exception):
+    """Raised from within a render, to stop it early as a newer job replaced it."""
+
+
+class LatestWins:
+    """Runs at most the latest job of each key, e.g. the illustration of a session's current chat.
+
+    A job waits `debounce` seconds before starting, and is dropped if a newer one arrived meanwhile.
+    Once started, it can poll whether it became stale to stop early, and its result is discarded if so.
+    """
+
+    def __init__(self, debounce: float = 0.25):
+        self.debounce = debounce
+        self._latest: dict[str, int] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    async def run(self, key: str, render: Callable[[Callable[[], bool]], Awaitable[T]]) -> Optional[T]:
+        """
+        Renders, unless superseded by a newer job for the same key.
+        :param render: called with a `stale()` function, which tells if it should stop early by raising Superseded.
+        Rendering must not block the event loop, e.g. `lambda stale: asyncio.to_thread(text2image, ..., stop=stale)`
+        :return: the rendered result, or None if superseded
+        """
+        with self._lock:
+            job = self._latest[key] = next(self._ids)
+
+        def stale() -> bool:
+            return self._latest.get(key) != job
+
+        await asyncio.sleep(self.debounce)
+        if stale():
+            metrics.increment("images.debounced")
+            return None
+        try:
+            result = await render(stale)
+        except Superseded:
+            metrics.increment("images.superseded")
+            return None
+
+        with self._lock:
+            if stale():
+                metrics.increment("images.superseded")
+                return None
+            del self._latest[key]
+        return result
+
+    def __len__(self) -> int:
+        return len(self._latest)
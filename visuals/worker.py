@@ -0,0 +1,131 @@
+"""Illustrations rendered by worker processes, keeping the pipeline, its GIL-heavy work and its crashes off the web server."""
+
+import asyncio
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from PIL.Image import Image
+
+from utils.metrics import metrics
+from visuals.jobs import Superseded
+
+
+class ImageWorkers:
+    """A small pool of processes each holding a resident pipeline, rendering illustrations in turn.
+
+    Workers are spawned rather than forked, as CUDA can't be used in forked processes.
+    A crashed worker (e.g. out of GPU memory) breaks the pool, which is replaced on the next render.
+    """
+
+    def __init__(self, processes: int = 1, timeout: float = 300.0, preset: Optional[str] = None):
+        self.processes = processes
+        self.timeout = timeout
+        self.preset = preset
+        self._context = multiprocessing.get_context("spawn")
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager = None  # Serves `_stopped`, the job ids to stop, to the workers
+        self._stopped = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Spawns the workers and loads their pipeline, ahead of the first illustration."""
+        executor = self._pool()
+        for _ in range(self.processes):
+            executor.submit(ready)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                if self._manager is None:
+                    self._manager = self._context.Manager()
+                    self._stopped = self._manager.dict()
+                self._executor = ProcessPoolExecutor(
+                    self.processes, mp_context=self._context, initializer=warm_worker, initargs=(self.preset,)
+                )
+            return self._executor
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+        metrics.increment("images.worker_restarts")
+
+    async def render_batch(
+        self,
+        batch: list[dict[str, Any]],
+        stop: Optional[Callable[[], bool]] = None,
+        preview: Optional[Callable[[list[Image]], None]] = None,
+    ) -> list[Optional[Image]]:
+        """
+        Same as diffuse.text2image_batch, rendered by a worker.
+        :param stop: polled while rendering, relayed to the worker to interrupt it and raise Superseded
+        :param preview: called with the previews the worker sends back while rendering
+        :return: an illustration per params, all None if they failed, timed out or their worker crashed
+        """
+        executor, job = self._pool(), next(self._ids)
+        previews = self._manager.Queue() if preview is not None else None
+        try:
+            future = executor.submit(render, job, self._stopped, batch, previews)
+        except BrokenProcessPool:
+            self._restart(executor)
+            return [None] * len(batch)
+
+        outcome = asyncio.wrap_future(future)
+        try:
+            async with asyncio.timeout(self.timeout):
+                while not outcome.done():
+                    if stop is not None and stop():
+                        self._stop(job, future)
+                        raise Superseded(f"Job {job} superseded")
+                    await asyncio.wait([outcome], timeout=0.1)
+                    while previews is not None and not previews.empty():
+                        preview(previews.get_nowait())
+            return outcome.result()
+        except TimeoutError:
+            print(f"Illustrations timed out after {self.timeout}s")
+            self._stop(job, future)
+            return [None] * len(batch)
+        except BrokenProcessPool:
+            print("Illustration worker crashed, restarting them")
+            self._restart(executor)
+            return [None] * len(batch)
+
+    def _stop(self, job: int, future) -> None:
+        if not future.cancel():  # Already running: let the worker see it at its next step
+            self._stopped[job] = True
+            future.add_done_callback(lambda _: self._stopped.pop(job, None))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def warm_worker(preset: Optional[str]) -> None:
+    from visuals.diffuse import warmup
+
+    warmup(preset)
+
+
+def ready() -> bool:
+    return True
+
+
+def render(job: int, stopped, batch: list[dict[str, Any]], previews=None) -> list[Optional[Image]]:
+    """
+    Runs in a worker: the same as diffuse.text2image_batch, stopping when the job is marked in `stopped`.
+    :param previews: a queue to send previews to, if any
+    """
+    from visuals.diffuse import text2image_batch
+
+    try:
+        return text2image_batch(batch, stop=lambda: job in stopped, preview=None if previews is None else previews.put)
+    except Superseded:
+        return [None] * len(batch)